@@ -0,0 +1,45 @@
+import json
+import subprocess
+import sys
+import time
+
+RUNS = 5
+
+
+def import_time(module: str) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+    return time.perf_counter() - started
+
+
+def mcp_tool_list_time() -> float:
+    requests = [
+        {"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {
+            "protocolVersion": "2024-11-05",
+            "capabilities": {},
+            "clientInfo": {"name": "bench", "version": "0"}
+        }},
+        {"jsonrpc": "2.0", "method": "notifications/initialized"},
+        {"jsonrpc": "2.0", "id": 2, "method": "tools/list"},
+    ]
+
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "server.py"],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        for request in requests:
+            process.stdin.write(json.dumps(request) + "\n")
+        process.stdin.flush()
+
+        for line in process.stdout:
+            if json.loads(line).get("id") == 2:
+                return time.perf_counter() - started
+        raise RuntimeError("MCP server exited without answering tools/list")
+    finally:
+        process.kill()
+
+
+if __name__ == "__main__":
+    for module in ("main", "server"):
+        print(f"import {module}: {min(import_time(module) for _ in range(RUNS)):.3f}s")
+    print(f"MCP tools/list: {min(mcp_tool_list_time() for _ in range(RUNS)):.3f}s")
@@ -0,0 +1,43 @@
+import json
+import sqlite3
+import uuid
+from typing import Optional, Any
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph.state import CompiledStateGraph
+
+_RUNS_TABLE = "CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, options TEXT NOT NULL)"
+
+
+def sqlite_checkpointer(path: str = ".checkpoints.sqlite") -> SqliteSaver:
+    return SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+
+
+def save_run_options(checkpointer: SqliteSaver, run_id: str, options: dict[str, Any]):
+    with checkpointer.lock, checkpointer.conn:
+        checkpointer.conn.execute(_RUNS_TABLE)
+        checkpointer.conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?)", (run_id, json.dumps(options)))
+
+
+def load_run_options(checkpointer: SqliteSaver, run_id: str) -> Optional[dict[str, Any]]:
+    with checkpointer.lock, checkpointer.conn:
+        checkpointer.conn.execute(_RUNS_TABLE)
+        row = checkpointer.conn.execute("SELECT options FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def run_config(thread_id: Optional[str] = None, **config) -> dict[str, Any]:
+    config["configurable"] = {"thread_id": thread_id or str(uuid.uuid4())}
+    return config
+
+
+def invoke_resumable(graph: CompiledStateGraph, initial_state: Any, config: dict[str, Any]) -> dict[str, Any]:
+    if graph.checkpointer is None:
+        return graph.invoke(initial_state, config)
+
+    snapshot = graph.get_state(config)
+    if snapshot.next:
+        return graph.invoke(None, config)
+    if snapshot.values:
+        return snapshot.values
+    return graph.invoke(initial_state, config)
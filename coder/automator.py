@@ -1,23 +1,29 @@
 import json
 import logging
+import os
 import re
-from collections import defaultdict
-from typing import List, TypedDict
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, TypedDict, Iterable, Optional, Callable
 
 from anthropic import BaseModel
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.prompt_values import PromptValue
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate, HumanMessagePromptTemplate
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.constants import END, START
 from langgraph.graph import StateGraph
 from pydantic import Field
 
 from action_frame import ActionFrame
+from checkpoints import invoke_resumable, run_config
 from coder.kotlinfile import UITestsKotlinFile
 from coder.viewextractor import ViewExtractor
-from utils import get_file_content
-from viewnode import without_fields
+from profiling import traced
+from structured_output import RepairingOutputParser
+from utils import get_prompt, estimate_tokens
+from viewnode import without_fields, fingerprint
 
 
 class ProjectFiles(BaseModel):
@@ -28,6 +34,8 @@ class ProjectFiles(BaseModel):
 class CoderState(TypedDict):
     scenario: str
     actions: list[dict]
+    interfaces_payload: str
+    implementation_payload: str
     interfaces: list[UITestsKotlinFile]
     implementation: list[UITestsKotlinFile]
     refactoring_index: int
@@ -36,47 +44,203 @@ class CoderState(TypedDict):
 class Automator:
 
     _logger = logging.getLogger(__name__)
-    _parser = PydanticOutputParser(pydantic_object=ProjectFiles)
-    _create_dsl_interfaces_template = get_file_content("./coder/prompts/create_dsl_interfaces.md")
-    _create_implementation_template = get_file_content("./coder/prompts/create_implementation_uiautomator.md")
-    _refactoring_template = get_file_content("./coder/prompts/uiautomator_refactoring.md")
-
-    def __init__(self, model: BaseChatModel):
+    # prompt budgets stay well below the scheduler tokens per minute, so a chunk never waits for an empty window
+    _interfaces_tokens_budget = 20_000
+    _implementation_tokens_budget = 20_000
+    _implementation_workers = 4
+
+    def __init__(self,
+                 model: BaseChatModel,
+                 checkpointer: Optional[BaseCheckpointSaver] = None,
+                 file_sink: Optional[Callable[[UITestsKotlinFile], None]] = None):
         graph_builder = StateGraph(CoderState)
 
+        graph_builder.add_node("prepare_payloads", self._prepare_payloads)
         graph_builder.add_node("create_interfaces", self._create_interfaces)
         graph_builder.add_node("create_implementation", self._create_implementation)
         graph_builder.add_node("refactoring", self._refactoring)
         graph_builder.add_node("extract_views", self._extract_views)
 
-        graph_builder.add_edge(START, "create_interfaces")
+        graph_builder.add_edge(START, "prepare_payloads")
+        graph_builder.add_conditional_edges("prepare_payloads", self._interfaces_needed)
         graph_builder.add_edge("create_interfaces", "create_implementation")
         graph_builder.add_conditional_edges("create_implementation", self._refactoring_needed)
         graph_builder.add_conditional_edges("refactoring", self._refactoring_needed)
         graph_builder.add_edge("extract_views", END)
 
-        self._graph = graph_builder.compile()
+        self._graph = graph_builder.compile(checkpointer=checkpointer)
         self._view_extractor = ViewExtractor(model)
+        self._parser = RepairingOutputParser(ProjectFiles, model, UITestsKotlinFile)
+        self._file_sink = file_sink
         self._model = model
 
+    @staticmethod
+    def _interfaces_needed(state: CoderState) -> str:
+        return "create_implementation" if state.get("interfaces") else "create_interfaces"
+
+    @staticmethod
+    def _flatten(nodes: list[dict]) -> list[str]:
+        flat = []
+        for node in nodes:
+            flat.append(json.dumps({k: v for k, v in node.items() if k != "children"}, sort_keys=True))
+            flat.extend(Automator._flatten(node.get("children", [])))
+        return flat
+
+    @staticmethod
+    def _screen_changes(screen_hierarchy: list[dict], hierarchy: list[dict]) -> Optional[dict]:
+        screen_nodes, nodes = Counter(Automator._flatten(screen_hierarchy)), Counter(Automator._flatten(hierarchy))
+        added, removed = nodes - screen_nodes, screen_nodes - nodes
+        if not added and not removed:
+            return None
+        return {
+            "added": [json.loads(node) for node in added.elements()],
+            "removed": [json.loads(node) for node in removed.elements()]
+        }
+
+    @staticmethod
+    def _screen_key(action: dict) -> str:
+        return action.get("screen_name") or fingerprint(action["screen_hierarchy"])
+
+    @staticmethod
+    def _serialize_by_screen(actions: list[dict], excluded_fields: tuple[str, ...] = ()) -> str:
+        screens, screen_ids, user_actions = [], {}, []
+
+        for action in actions:
+            screen_key = Automator._screen_key(action)
+            if screen_key not in screen_ids:
+                screen_ids[screen_key] = len(screens)
+                screens.append({
+                    "screen_id": screen_ids[screen_key],
+                    "screen_name": action.get("screen_name"),
+                    "screen_description": action["screen_description"],
+                    "screen_hierarchy": action["screen_hierarchy"]
+                })
+
+            user_action = {
+                k: v for k, v in action.items()
+                if k not in ("screen_name", "screen_description", "screen_hierarchy")
+            }
+            user_action["screen_id"] = screen_ids[screen_key]
+            changes = Automator._screen_changes(screens[screen_ids[screen_key]]["screen_hierarchy"],
+                                                action["screen_hierarchy"])
+            if changes:
+                user_action["screen_changes"] = changes
+            user_actions.append(user_action)
+
+        payload = {
+            "screens": [{k: v for k, v in screen.items() if k not in excluded_fields} for screen in screens],
+            "user_actions": [{k: v for k, v in action.items() if k not in excluded_fields} for action in user_actions]
+        }
+        return json.dumps(payload, indent=None)
+
+    @traced(category="node")
+    def _prepare_payloads(self, state: CoderState) -> CoderState:
+        if not state.get("interfaces"):
+            state["interfaces_payload"] = self._serialize_by_screen(state["actions"], ("element_xpath",))
+        state["implementation_payload"] = self._serialize_by_screen(state["actions"], ("screen_description",))
+        return state
+
+    @traced(category="node")
     def _create_interfaces(self, state: CoderState) -> CoderState:
-        user_actions = [
-            {k: v for k, v in action.items() if k != "element_xpath"} for action in state["actions"]
-        ]
-        request = PromptTemplate.from_template(self._create_dsl_interfaces_template).invoke({
-            "scenario": state["scenario"],
-            "user_actions": json.dumps(user_actions, indent=None),
+        state["interfaces"] = self._generate_interfaces(state["scenario"], state["interfaces_payload"])
+        return state
+
+    def _generate_interfaces(self, scenario: str, user_actions: str) -> list[UITestsKotlinFile]:
+        request = PromptTemplate.from_template(get_prompt("./coder/prompts/create_dsl_interfaces.md")).invoke({
+            "scenario": scenario,
+            "user_actions": user_actions,
             "format_instructions": self._parser.get_format_instructions()
         })
+        if self._file_sink:
+            return self._stream_files(request, self._file_sink)
+
         response = self._model.invoke(request)
 
         self._logger.info(f"Write interfaces: {response.usage_metadata}")
-        state["interfaces"] = self._parser.parse(response.text()).kotlin_files
-        return state
+        return self._parser.parse(response.text(), request.to_messages()).kotlin_files
+
+    def _stream_files(self,
+                      request: PromptValue,
+                      on_file: Callable[[UITestsKotlinFile], None]) -> list[UITestsKotlinFile]:
+        chunks = (chunk.text() for chunk in self._model.stream(request))
+        return self._parser.parse_stream(chunks, request.to_messages(), on_file).kotlin_files
+
+    def _take_by_budget(self,
+                        batch: list[tuple[str, list[dict]]],
+                        budget: int) -> list[tuple[str, list[dict]]]:
+        chunk, chunk_tokens = [], 0
+        for scenario, actions in batch:
+            tokens = estimate_tokens(scenario + self._serialize_by_screen(actions, ("element_xpath",)))
+            if chunk and chunk_tokens + tokens > budget:
+                break
+            chunk.append((scenario, actions))
+            chunk_tokens += tokens
+        return chunk
+
+    @staticmethod
+    def _interfaces_text(interfaces: dict[str, UITestsKotlinFile]) -> str:
+        return "\n\n".join(
+            f"// {path}\n{file.source}" for path, file in interfaces.items()
+            if os.path.normpath(path).startswith("dsl" + os.sep)
+        )
+
+    def _extend_interfaces(self, interfaces: dict[str, UITestsKotlinFile], scenario: str, actions: list[dict]):
+        known_interfaces = self._interfaces_text(interfaces)
+        if known_interfaces:
+            scenario += "\n\nAlready generated interfaces, extend them and keep them compatible:\n\n"
+            scenario += known_interfaces
+
+        user_actions = self._serialize_by_screen(actions, ("element_xpath",))
+        for file in self._generate_interfaces(scenario, user_actions):
+            interfaces[file.relative_filepath] = file
+
+    def _create_shared_interfaces(self, batch: list[tuple[str, list[dict]]]) -> list[UITestsKotlinFile]:
+        interfaces: dict[str, UITestsKotlinFile] = {}
+
+        while batch:
+            # interfaces generated so far go into every following prompt, so they share its budget
+            budget = self._interfaces_tokens_budget - estimate_tokens(self._interfaces_text(interfaces))
+            chunk = self._take_by_budget(batch, budget)
+            batch = batch[len(chunk):]
+            scenarios = "\n".join(f"{i + 1}. {scenario.strip()}" for i, (scenario, _) in enumerate(chunk))
+
+            self._extend_interfaces(interfaces, scenarios, self._union_actions(chunk))
+
+        return list(interfaces.values())
 
+    @staticmethod
+    def _union_actions(batch: list[tuple[str, list[dict]]], key_fields: tuple[str, ...] = ()) -> list[dict]:
+        union_actions = {}
+        for _, actions in batch:
+            for action in actions:
+                key = (action["element_name"], action["element_action"], action["screen_description"])
+                union_actions.setdefault(key + tuple(action[field] for field in key_fields), action)
+        return list(union_actions.values())
+
+    @staticmethod
+    def _to_action(frame: ActionFrame) -> dict:
+        return {
+            "element_name": frame["element"]["element"]["name"],
+            "element_xpath": frame["element"]["element"]["xpath"],
+            "element_action": frame["type"],
+            "element_action_data": frame.get("data"),
+            "screen_name": frame["element"]["element"].get("screen"),
+            "screen_description": frame["element"]["element"]["screen_description"],
+            "screen_hierarchy": without_fields(frame["element"]["hierarchy"], ["bounds", "index", "package"])
+        }
+
+    @staticmethod
+    def _has_element(frame: ActionFrame) -> bool:
+        # interruptions for elements that were not found carry only the request and the hierarchy
+        return "element" in frame["element"]
+
+    def _to_actions(self, frames: list[ActionFrame]) -> list[dict]:
+        return [self._to_action(frame) for frame in frames if self._has_element(frame)]
+
+    @traced(category="node")
     def _create_implementation(self, state: CoderState) -> CoderState:
         prompt_template = ChatPromptTemplate.from_messages([
-            SystemMessage(self._create_implementation_template),
+            SystemMessage(get_prompt("./coder/prompts/create_implementation_uiautomator.md")),
             HumanMessagePromptTemplate.from_template("""
 Interfaces:
 {interfaces}
@@ -91,39 +255,59 @@ User Interactions:
                     """)
         ])
 
-        user_actions = [
-            {k: v for k, v in action.items() if k != "screen_description"}
-            for action in state["actions"]
-        ]
         request = prompt_template.invoke({
             "interfaces": "\n\n".join(
                 [f"// {file.relative_filepath}\n{file.source}" for file in state["interfaces"]]
             ),
             "scenario": state["scenario"],
-            "user_actions": json.dumps(user_actions, indent=None),
+            "user_actions": state["implementation_payload"],
             "format_instructions": self._parser.get_format_instructions()
         })
+        if self._file_sink:
+            return self._stream_implementation(state, request)
+
         response = self._model.invoke(request)
 
         self._logger.info(f"Write implementation: {response.usage_metadata}")
-        state["implementation"] = self._parser.parse(response.text()).kotlin_files
+        state["implementation"] = self._parser.parse(response.text(), request.to_messages()).kotlin_files
         state["refactoring_index"] = 0
         return state
 
+    def _stream_implementation(self, state: CoderState, request: PromptValue) -> CoderState:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            refactorings = []
+
+            def on_file(file: UITestsKotlinFile):
+                self._file_sink(file)
+                refactorings.append(executor.submit(self._refactor, file.model_copy()))
+
+            files = self._stream_files(request, on_file)
+            refactored = {file.relative_filepath: file for file in (future.result() for future in refactorings)}
+
+        state["implementation"] = [refactored.get(file.relative_filepath, file) for file in files]
+        for file in state["implementation"]:
+            self._file_sink(file)
+        state["refactoring_index"] = len(state["implementation"])
+        return state
+
     def _refactoring_needed(self, state: CoderState) -> str:
         if state["refactoring_index"] < len(state["implementation"]):
             return "refactoring"
         else:
             return "extract_views"
 
+    @traced(category="node")
     def _refactoring(self, state: CoderState) -> CoderState:
-        file = state["implementation"][state["refactoring_index"]]
+        self._refactor(state["implementation"][state["refactoring_index"]])
+        state["refactoring_index"] += 1
+        return state
+
+    def _refactor(self, file: UITestsKotlinFile) -> UITestsKotlinFile:
         file.source = self._model.invoke([
-            SystemMessage(self._refactoring_template),
+            SystemMessage(get_prompt("./coder/prompts/uiautomator_refactoring.md")),
             HumanMessage(f"### Source code:\n{file.source}")
         ]).text()
-        state["refactoring_index"] += 1
-        return state
+        return file
 
     @staticmethod
     def _group_by_component(file_list) -> dict[str]:
@@ -146,6 +330,7 @@ User Interactions:
         result["screens_implementation"] = screens
         return result
 
+    @traced(category="node")
     def _extract_views(self, state: CoderState) -> CoderState:
         previous_implementation = self._group_by_component(state["implementation"])
         screens_implementation = previous_implementation["screens_implementation"]
@@ -164,21 +349,132 @@ User Interactions:
         state["implementation"] = new_implementation
         return state
 
-    def code(self, scenario: str, frames: list[ActionFrame]):
-        actions = [
-            {
-                "element_name": frames["element"]["element"]["name"],
-                "element_xpath": frames["element"]["element"]["xpath"],
-                "element_action": frames["type"],
-                "element_action_data": frames.get("data"),
-                "screen_description": frames["element"]["element"]["screen_description"],
-                "screen_hierarchy": without_fields(frames["element"]["hierarchy"], ["bounds", "index", "package"])
-            } for frames in frames
-        ]
-        result = self._graph.invoke({
+    def code(self, scenario: str, frames: list[ActionFrame], thread_id: Optional[str] = None):
+        result = invoke_resumable(self._graph, {
             "scenario": scenario,
-            "actions": actions
-        })
+            "actions": self._to_actions(frames)
+        }, run_config(thread_id))
         files: list[UITestsKotlinFile] = result["interfaces"]
         files.extend(result["implementation"])
         return files
+
+    def _chunk_by_screen(self, actions: list[dict]) -> list[list[dict]]:
+        screens: dict[str, list[dict]] = {}
+        for action in actions:
+            screens.setdefault(self._screen_key(action), []).append(action)
+
+        chunks = []
+        chunk, chunk_tokens = [], 0
+        for screen_actions in screens.values():
+            tokens = estimate_tokens(self._serialize_by_screen(screen_actions, ("screen_description",)))
+            if chunk and chunk_tokens + tokens > self._implementation_tokens_budget:
+                chunks.append(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.extend(screen_actions)
+            chunk_tokens += tokens
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _merge_implementations(self,
+                               interfaces: list[UITestsKotlinFile],
+                               implementations: list[list[UITestsKotlinFile]]) -> list[UITestsKotlinFile]:
+        merged: dict[str, UITestsKotlinFile] = {}
+        screens_implementations = []
+
+        for files in implementations:
+            for file in files:
+                if file.relative_filepath.endswith("ScreensUiAutomator.kt"):
+                    screens_implementations.append(file)
+                elif file.relative_filepath not in merged:
+                    merged[file.relative_filepath] = file
+                elif merged[file.relative_filepath].source != file.source:
+                    self._logger.warning(f"Screen groups implement {file.relative_filepath} differently, keep the first")
+
+        if screens_implementations:
+            screens_implementation = self._merge_screens_implementations(interfaces, screens_implementations)
+            merged[screens_implementation.relative_filepath] = screens_implementation
+        return list(merged.values())
+
+    def _merge_screens_implementations(self,
+                                       interfaces: list[UITestsKotlinFile],
+                                       screens_implementations: list[UITestsKotlinFile]) -> UITestsKotlinFile:
+        if len(screens_implementations) == 1:
+            return screens_implementations[0]
+
+        screens_interface = next(
+            (file.source for file in interfaces if os.path.basename(file.relative_filepath) == "Screens.kt"), ""
+        )
+        file = screens_implementations[0].model_copy()
+        file.source = self._model.invoke([
+            SystemMessage(get_prompt("./coder/prompts/merge_screens_implementation.md")),
+            HumanMessage(f"### Screens interface:\n{screens_interface}\n\n### Partial implementations:\n\n" +
+                         "\n\n".join(implementation.source for implementation in screens_implementations))
+        ]).text()
+        return file
+
+    def code_batch(self, scenarios: list[tuple[str, list[ActionFrame]]], thread_id: Optional[str] = None):
+        batch = [(scenario, self._to_actions(frames)) for scenario, frames in scenarios]
+        interfaces = self._create_shared_interfaces(batch)
+
+        # Tests are scenario specific and come with the interfaces, implementations are per screen:
+        # build them from the actions of all scenarios, a group of screens per graph run
+        chunks = self._chunk_by_screen(self._union_actions(batch, ("element_xpath",)))
+
+        def implement(index: int, actions: list[dict]) -> list[UITestsKotlinFile]:
+            screens = {self._screen_key(action) for action in actions}
+            scenario = "\n".join(
+                f"{i + 1}. {scenario.strip()}" for i, scenario in enumerate(
+                    scenario for scenario, scenario_actions in batch
+                    if any(self._screen_key(action) in screens for action in scenario_actions)
+                )
+            )
+            if len(chunks) > 1:
+                scenario += ("\n\nImplement only the interfaces used by the user interactions below, "
+                             "the other screens are implemented separately.")
+
+            result = invoke_resumable(self._graph, {
+                "scenario": scenario,
+                "actions": actions,
+                "interfaces": interfaces
+            }, run_config(f"{thread_id}-{index}" if thread_id else None))
+            return result["implementation"]
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(chunks), self._implementation_workers))) as executor:
+            implementations = list(executor.map(implement, range(len(chunks)), chunks))
+        return interfaces + self._merge_implementations(interfaces, implementations)
+
+    def code_stream(self, scenario: str, frames: Iterable[ActionFrame], thread_id: Optional[str] = None):
+        actions, screen_actions, screen = [], [], None
+        interfaces: dict[str, UITestsKotlinFile] = {}
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = []
+            for frame in frames:
+                if not self._has_element(frame):
+                    self._logger.warning(f"Skip {frame['type']} frame without element: {frame['data']}")
+                    continue
+
+                frame_screen = frame["element"]["element"]["screen"]
+                if screen_actions and frame_screen != screen:
+                    pending.append(executor.submit(self._extend_interfaces, interfaces, scenario, screen_actions))
+                    screen_actions = []
+
+                screen = frame_screen
+                action = self._to_action(frame)
+                actions.append(action)
+                screen_actions.append(action)
+
+            if screen_actions:
+                pending.append(executor.submit(self._extend_interfaces, interfaces, scenario, screen_actions))
+            for future in pending:
+                future.result()
+
+        result = invoke_resumable(self._graph, {
+            "scenario": scenario,
+            "actions": actions,
+            "interfaces": list(interfaces.values())
+        }, run_config(thread_id))
+        files = list(interfaces.values())
+        files.extend(result["implementation"])
+        return files
@@ -0,0 +1,175 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional, TypedDict
+
+from langchain_core.language_models import BaseChatModel
+
+from coder.builder import GradleBuildAgent
+from coder.kotlinfile import UITestsKotlinFile
+
+_ignored = shutil.ignore_patterns("build", ".gradle", ".idea", ".kotlin")
+_copied = {"local.properties"}
+
+_worker_copy: Optional[str] = None
+_worker_agent: Optional[GradleBuildAgent] = None
+
+
+class BuildResult(TypedDict):
+    successful: bool
+    files: list[UITestsKotlinFile]
+
+
+def _link_or_copy(source: str, destination: str):
+    if os.path.basename(source) in _copied:
+        shutil.copy2(source, destination)
+        return
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _init_worker(copies: "multiprocessing.Queue",
+                 model_factory: Callable[..., BaseChatModel],
+                 limits: dict[str, Any]):
+    global _worker_copy, _worker_agent
+    _worker_copy = copies.get()
+    _worker_agent = GradleBuildAgent(_worker_copy, model_factory(**limits))
+
+
+def _verify(project_dir: str, source_root: str, files: list[UITestsKotlinFile]) -> BuildResult:
+    sources = os.path.join(_worker_copy, source_root)
+    shutil.rmtree(sources, ignore_errors=True)
+    original = os.path.join(project_dir, source_root)
+    if os.path.isdir(original):
+        shutil.copytree(original, sources)
+
+    for file in files:
+        path = os.path.join(sources, file.relative_filepath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(file.source)
+
+    result = _worker_agent.build_and_fix()
+
+    fixed = []
+    for file in files:
+        with open(os.path.join(sources, file.relative_filepath), "r", encoding="utf-8") as f:
+            source = f.read()
+        if source != file.source:
+            fixed.append(UITestsKotlinFile(relative_filepath=file.relative_filepath, source=source))
+    return BuildResult(successful="BUILD SUCCESSFUL" in result["build_output"], files=fixed)
+
+
+class BuildPool:
+    """Verifies generated tests in parallel worker processes: tests are sharded across hard-linked copies
+    of the project, each copy compiles and fixes its shard with the shared files, then the fixes are merged
+    back and the merged project is compiled once"""
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self,
+                 project_dir: str,
+                 model_factory: Callable[..., BaseChatModel],
+                 source_root: str = "app/src/androidTest/java/verterai/example",
+                 workers: int = 2,
+                 work_dir: Optional[str] = None,
+                 requests_per_minute: int = 50,
+                 tokens_per_minute: int = 40_000):
+        self._project_dir = os.path.abspath(project_dir)
+        self._model_factory = model_factory
+        self._source_root = source_root
+        self._workers = workers
+        self._work_dir = work_dir
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+
+    def _worker_limits(self, workers: int) -> dict[str, Any]:
+        # every worker process has its own scheduler, together they must stay within the provider limits
+        return {
+            "requests_per_minute": max(self._requests_per_minute // workers, 1),
+            "tokens_per_minute": max(self._tokens_per_minute // workers, 1)
+        }
+
+    def _create_copies(self, root: str, count: int) -> list[str]:
+        copies = []
+        for index in range(count):
+            copy = os.path.join(root, f"project-{index}")
+            shutil.copytree(self._project_dir, copy, ignore=_ignored, copy_function=_link_or_copy, symlinks=True)
+            copies.append(copy)
+        return copies
+
+    def _dedupe(self, files: list[UITestsKotlinFile]) -> list[UITestsKotlinFile]:
+        unique: dict[str, UITestsKotlinFile] = {}
+        for file in files:
+            # `./tests/A.kt` and `tests/A.kt` are the same file
+            file = file.model_copy(update={"relative_filepath": os.path.normpath(file.relative_filepath)})
+            previous = unique.get(file.relative_filepath)
+            if previous is not None and previous.source != file.source:
+                self.logger.warning(f"{file.relative_filepath} is generated differently, keep the last one")
+            unique[file.relative_filepath] = file
+        return list(unique.values())
+
+    def _shard(self, files: list[UITestsKotlinFile]) -> list[list[UITestsKotlinFile]]:
+        is_test = [file.relative_filepath.split(os.sep, 1)[0] == "tests" for file in files]
+        tests = [file for file, test in zip(files, is_test) if test]
+        shared = [file for file, test in zip(files, is_test) if not test]
+        shards = min(self._workers, len(tests)) or 1
+        return [shared + tests[index::shards] for index in range(shards)]
+
+    def verify(self, files: list[UITestsKotlinFile]) -> BuildResult:
+        files = self._dedupe(files)
+        batches = self._shard(files)
+
+        context = multiprocessing.get_context("spawn")
+        with tempfile.TemporaryDirectory(prefix="build-pool-", dir=self._work_dir) as root:
+            copies = context.Queue()
+            for copy in self._create_copies(root, len(batches)):
+                copies.put(copy)
+
+            initargs = (copies, self._model_factory, self._worker_limits(len(batches)))
+            with ProcessPoolExecutor(max_workers=len(batches), mp_context=context,
+                                     initializer=_init_worker, initargs=initargs) as executor:
+                results = list(executor.map(
+                    _verify, [self._project_dir] * len(batches), [self._source_root] * len(batches), batches
+                ))
+
+        self._merge(files, results)
+        if len(results) == 1:
+            return BuildResult(successful=results[0]["successful"], files=self._changed(files))
+
+        self.logger.info(f"Compile merged fixes of {len(results)} shards")
+        result = GradleBuildAgent(self._project_dir, self._model_factory()).build_and_fix()
+        return BuildResult(successful="BUILD SUCCESSFUL" in result["build_output"], files=self._changed(files))
+
+    def _changed(self, files: list[UITestsKotlinFile]) -> list[UITestsKotlinFile]:
+        changed = []
+        for file in files:
+            with open(os.path.join(self._project_dir, self._source_root, file.relative_filepath), "r",
+                      encoding="utf-8") as f:
+                source = f.read()
+            if source != file.source:
+                changed.append(UITestsKotlinFile(relative_filepath=file.relative_filepath, source=source))
+        return changed
+
+    def _merge(self, files: list[UITestsKotlinFile], results: list[BuildResult]):
+        fixed: dict[str, UITestsKotlinFile] = {}
+        for result in results:
+            for file in result["files"]:
+                previous = fixed.get(file.relative_filepath)
+                if previous is not None and previous.source != file.source:
+                    self.logger.warning(f"{file.relative_filepath} is fixed differently in several shards, "
+                                        f"keep the first one")
+                    continue
+                fixed[file.relative_filepath] = file
+
+        for file in files:
+            file = fixed.get(file.relative_filepath, file)
+            path = os.path.join(self._project_dir, self._source_root, file.relative_filepath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(file.source)
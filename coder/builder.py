@@ -9,10 +9,13 @@ from langchain_core.messages import HumanMessage, SystemMessage, BaseMessage, An
 from langgraph.constants import START
 from langgraph.graph import StateGraph, END, add_messages
 from langchain_core.tools import tool
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt import ToolNode
 
-from utils import get_file_content
+from checkpoints import invoke_resumable, run_config
+from profiling import span, traced
+from utils import get_prompt
 
 
 class AgentState(TypedDict):
@@ -26,11 +29,28 @@ class AgentState(TypedDict):
 
 
 class GradleBuildAgent:
-    def __init__(self, project_dir: str, model: BaseChatModel):
+    def __init__(self, project_dir: str, model: BaseChatModel, checkpointer: Optional[BaseCheckpointSaver] = None):
         self._project_dir = os.path.abspath(project_dir)
         self._model = model
+        self._checkpointer = checkpointer
         self.graph = self._create_graph()
 
+    def _run_gradle(self) -> str:
+        try:
+            gradlew = os.path.join(self._project_dir, "gradlew")
+            os.chmod(gradlew, os.stat(gradlew).st_mode | 0o111)
+            with span("gradlew", "subprocess"):
+                result = subprocess.run(
+                    [gradlew, "compileDebugAndroidTestKotlin"],
+                    cwd=self._project_dir,
+                    capture_output=True,
+                    text=True,
+                    timeout=300  # 5 минут на выполнение
+                )
+            return result.stdout + "\n" + result.stderr
+        except Exception as e:
+            return str(e)
+
     def _create_tools(self):
         @tool
         def run_gradle_compile() -> str:
@@ -39,17 +59,7 @@ class GradleBuildAgent:
             and returns the output of the command. Use this tool to run the build
             and get information about compilation errors.
             """
-            try:
-                os.chdir(self._project_dir)
-                result = subprocess.run(
-                    ["./gradlew", "compileDebugAndroidTestKotlin"],
-                    capture_output=True,
-                    text=True,
-                    timeout=300  # 5 минут на выполнение
-                )
-                return result.stdout + "\n" + result.stderr
-            except Exception as e:
-                return str(e)
+            return self._run_gradle()
 
         @tool
         def read_file(file_path: str) -> str:
@@ -72,8 +82,10 @@ class GradleBuildAgent:
             """
             try:
                 full_path = os.path.join(self._project_dir, file_path)
-                with open(full_path, 'w', encoding='utf-8') as file:
+                # Replace instead of rewriting in place: working copies of the project share inodes
+                with open(full_path + ".tmp", 'w', encoding='utf-8') as file:
                     file.write(content)
+                os.replace(full_path + ".tmp", full_path)
                 return f"File {file_path} updated!"
             except Exception as e:
                 return str(e)
@@ -104,20 +116,9 @@ class GradleBuildAgent:
         tools = self._create_tools()
         self._model = self._model.bind_tools(tools)
 
+        @traced(category="node")
         def run_build(state: AgentState) -> AgentState:
-            os.chdir(self._project_dir)
-            try:
-                os.chmod("./gradlew", os.stat("./gradlew").st_mode | 0o111)
-                result = subprocess.run(
-                    ["./gradlew", "compileDebugAndroidTestKotlin"],
-                    capture_output=True,
-                    text=True,
-                    timeout=300
-                )
-                output = result.stdout + "\n" + result.stderr
-            except Exception as e:
-                output = str(e)
-
+            output = self._run_gradle()
             state["build_output"] = output
             state["errors"] = self._parse_build_errors(output)
             simplified_output = _simplify_build_output(output)
@@ -166,6 +167,7 @@ class GradleBuildAgent:
             else:
                 return END
 
+        @traced(category="node")
         def fix_errors(state: AgentState) -> AgentState:
             if state["current_error"]:
                 file_path = state["current_error"].get("file", "")
@@ -213,7 +215,7 @@ class GradleBuildAgent:
                                        lambda state: "tools" if state["messages"][-1].tool_calls else END)
         workflow.add_edge("tools", "fix_errors")
 
-        return workflow.compile()
+        return workflow.compile(checkpointer=self._checkpointer)
 
     @staticmethod
     def _parse_build_errors(output: str) -> List[Dict[str, str]]:
@@ -258,9 +260,9 @@ class GradleBuildAgent:
 
         return errors
 
-    def build_and_fix(self) -> Dict[str, Any]:
+    def build_and_fix(self, thread_id: Optional[str] = None) -> Dict[str, Any]:
         initial_state = AgentState(
-            messages=[SystemMessage(get_file_content("./coder/prompts/fix_build.md"))],
+            messages=[SystemMessage(get_prompt("./coder/prompts/fix_build.md"))],
             build_output="",
             errors=[],
             files_examined=[],
@@ -269,9 +271,4 @@ class GradleBuildAgent:
             current_error=None
         )
 
-        return self.graph.invoke(
-            initial_state,
-            {
-                "recursion_limit": 100
-            }
-        )
+        return invoke_resumable(self.graph, initial_state, run_config(thread_id, recursion_limit=100))
@@ -2,14 +2,15 @@ import logging
 from typing import TypedDict
 
 from langchain_core.messages import SystemMessage
-from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
 from langgraph.constants import START
 from langgraph.graph import StateGraph
 from pydantic import BaseModel, Field
 
 from coder.kotlinfile import UITestsKotlinFile
-from utils import get_file_content
+from profiling import traced
+from structured_output import RepairingOutputParser
+from utils import get_prompt
 
 
 class ViewExtraction(BaseModel):
@@ -29,9 +30,7 @@ class ExtractorState(TypedDict):
 
 class ViewExtractor:
 
-    _extract_view_template = get_file_content("./coder/prompts/extract_view.md")
     _logger = logging.getLogger(__name__)
-    _parser = PydanticOutputParser(pydantic_object=ViewExtraction)
 
     def __init__(self, model):
         graph_builder = StateGraph(ExtractorState)
@@ -39,12 +38,13 @@ class ViewExtractor:
         graph_builder.add_edge(START, "extract_view")
 
         self._graph = graph_builder.compile()
+        self._parser = RepairingOutputParser(ViewExtraction, model, UITestsKotlinFile)
         self._model = model
 
+    @traced(category="node")
     def _extract_view(self, state: ExtractorState) -> ExtractorState:
-        parser = PydanticOutputParser(pydantic_object=ViewExtraction)
         prompt_template = ChatPromptTemplate.from_messages([
-            SystemMessage(self._extract_view_template),
+            SystemMessage(get_prompt("./coder/prompts/extract_view.md")),
             HumanMessagePromptTemplate.from_template("""
 # Actions class:
 {actions}
@@ -63,11 +63,11 @@ class ViewExtractor:
             "actions": state["actions"].source,
             "assertions": state["assertions"].source,
             "screens_implementation": state["screens_implementation"].source,
-            "format_instructions": parser.get_format_instructions()
+            "format_instructions": self._parser.get_format_instructions()
         })
         response = self._model.invoke(request)
 
-        result: ViewExtraction = self._parser.parse(response.text())
+        result: ViewExtraction = self._parser.parse(response.text(), request.to_messages())
         state["actions"] = result.actions
         state["assertions"] = result.assertions
         state["screens_implementation"] = result.screens_implementation
@@ -0,0 +1,138 @@
+import logging
+from collections import deque
+from time import sleep
+from typing import Optional
+from xml.etree import ElementTree
+
+from uiautomator2 import Device, XPathElementNotFoundError
+
+from action_frame import ActionFrame
+from explorer.hierarchy_capture import HierarchyCapture
+from explorer.screen_graph import ScreenGraph, Screen
+from profiling import traced
+from viewnode import fingerprint
+
+
+def interactive_elements(hierarchy: str) -> list[dict[str]]:
+    elements, seen = [], {}
+
+    for node in ElementTree.fromstring(hierarchy).iter("node"):
+        conditions = [
+            f"@{attribute}='{node.get(attribute)}'"
+            for attribute in ("resource-id", "content-desc", "text")
+            if node.get(attribute) and "'" not in node.get(attribute)
+        ]
+        xpath = f"//{node.get('class', '*')}" + (f"[{' and '.join(conditions)}]" if conditions else "")
+
+        # the position has to count every node the xpath matches, not only the clickable ones
+        seen[xpath] = seen.get(xpath, 0) + 1
+        if node.get("clickable") != "true" or node.get("enabled") == "false":
+            continue
+        if seen[xpath] > 1:
+            xpath = f"({xpath})[{seen[xpath]}]"
+
+        name = node.get("content-desc") or node.get("text") or node.get("resource-id") or node.get("class")
+        elements.append({"name": name, "xpath": xpath})
+
+    return elements
+
+
+class AppCrawler:
+    """Breadth-first crawler that maps the app screens reachable by clicks into a ScreenGraph"""
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, device: Device, screen_graph: Optional[ScreenGraph] = None,
+                 max_screens: int = 50, action_delay: float = 1.0):
+        self._device = device
+        self._graph = screen_graph or ScreenGraph()
+        self._max_screens = max_screens
+        self._action_delay = action_delay
+
+    def _observe(self, package: str) -> str:
+        dump = HierarchyCapture.of(self._device).capture()
+        hierarchy = dump.xml
+        screen_id = fingerprint(dump.tree, package)
+
+        if screen_id not in self._graph.screens:
+            texts = [node.get("text") for node in ElementTree.fromstring(hierarchy).iter("node") if node.get("text")]
+            self._graph.add_screen(screen_id, Screen(
+                activity=self._device.app_current().get("activity", ""),
+                texts=texts,
+                elements=interactive_elements(hierarchy)
+            ))
+        return screen_id
+
+    @traced("restart", "device")
+    def _restart(self, package: str):
+        self._device.app_start(package, stop=True)
+        sleep(self._action_delay)
+
+    @traced("back", "device")
+    def _back(self):
+        self._device.press("back")
+        sleep(self._action_delay)
+
+    @traced("perform", "device")
+    def _perform(self, action: ActionFrame) -> bool:
+        try:
+            self._device.xpath(action["element"]["element"]["xpath"]).click()
+        except XPathElementNotFoundError:
+            return False
+        sleep(self._action_delay)
+        return True
+
+    def go_to(self, target: str, package: Optional[str] = None) -> bool:
+        package = package or self._device.app_current()["package"]
+        current = self._observe(package)
+        if current == target:
+            return True
+
+        path = self._graph.shortest_path(current, target)
+        if path is None:
+            self._back()
+            if self._device.app_current()["package"] == package:
+                path = self._graph.shortest_path(self._observe(package), target)
+        if path is None:
+            self._restart(package)
+            path = self._graph.shortest_path(self._observe(package), target)
+            if path is None:
+                return False
+
+        for action in path:
+            if not self._perform(action):
+                return False
+        return self._observe(package) == target
+
+    def crawl(self) -> ScreenGraph:
+        package = self._device.app_current()["package"]
+        self._graph.root = self._graph.root or self._observe(package)
+
+        queue = deque([self._graph.root])
+        visited = {self._graph.root}
+
+        while queue and len(self._graph.screens) < self._max_screens:
+            screen_id = queue.popleft()
+
+            for element in self._graph.screens[screen_id]["elements"]:
+                if not self.go_to(screen_id, package):
+                    self.logger.warning(f"Screen {screen_id} is unreachable")
+                    break
+
+                action = ActionFrame(element={"element": element}, type="click", data=None)
+                if not self._perform(action):
+                    continue
+
+                if self._device.app_current()["package"] != package:
+                    self._restart(package)
+                    continue
+
+                target = self._observe(package)
+                if target != screen_id:
+                    self._graph.add_transition(screen_id, target, action)
+                    if target not in visited:
+                        self.logger.info(f"New screen {target} by '{element['name']}'")
+                        visited.add(target)
+                        queue.append(target)
+
+        return self._graph
@@ -0,0 +1,102 @@
+import re
+from typing import Iterator
+
+import numpy as np
+
+from viewnode import ViewNode, count_nodes
+
+_searchable_fields = ("text", "content-desc", "resource-id", "class")
+
+
+def _words(node: ViewNode) -> str:
+    values = []
+    for field in _searchable_fields:
+        value = node.get(field)
+        if value:
+            if field == "class":
+                value = value.rsplit(".", 1)[-1]
+            elif field == "resource-id":
+                value = value.rsplit("/", 1)[-1]
+            values.append(value)
+    return re.sub(r"[^0-9a-zA-Z]+", " ", " ".join(values)).strip().lower()
+
+
+def _ngrams(text: str, n: int) -> list[str]:
+    text = f" {text} "
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+def _walk(nodes: list[ViewNode], path: tuple[int, ...] = (), context: tuple[str, ...] = ()) \
+        -> Iterator[tuple[tuple[int, ...], ViewNode, tuple[str, ...]]]:
+    for position, node in enumerate(nodes):
+        node_path = path + (position,)
+        yield node_path, node, context
+        children = node.get("children")
+        if children:
+            yield from _walk(children, node_path, (context + (_words(node),))[-2:])
+
+
+class ElementIndex:
+    """Character n-gram TF-IDF index over hierarchy nodes for retrieving element candidates,
+    stored as postings of gram -> (rows, normalized weights)"""
+
+    def __init__(self, hierarchy: list[ViewNode], ngram: int = 3, context_weight: float = 0.5):
+        self._ngram = ngram
+        self._paths: list[tuple[int, ...]] = []
+        self._nodes: list[ViewNode] = []
+
+        postings: dict[str, tuple[list[int], list[float]]] = {}
+        for row, (path, node, context) in enumerate(_walk(hierarchy)):
+            counts: dict[str, float] = {}
+            for weight, text in [(1.0, _words(node))] + [(context_weight, words) for words in context]:
+                for gram in _ngrams(text, ngram):
+                    counts[gram] = counts.get(gram, 0.0) + weight
+            for gram, count in counts.items():
+                rows, weights = postings.setdefault(gram, ([], []))
+                rows.append(row)
+                weights.append(count)
+            self._paths.append(path)
+            self._nodes.append(node)
+
+        self._idf: dict[str, float] = {}
+        self._postings: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        norms = np.zeros(len(self._nodes), dtype=np.float32)
+        for gram, (rows, weights) in postings.items():
+            self._idf[gram] = float(np.log((1 + len(self._nodes)) / (1 + len(rows)))) + 1
+            rows, weights = np.array(rows, dtype=np.int32), np.array(weights, dtype=np.float32) * self._idf[gram]
+            norms[rows] += weights ** 2
+            self._postings[gram] = (rows, weights)
+
+        norms = np.sqrt(norms)
+        norms[norms == 0] = 1
+        for rows, weights in self._postings.values():
+            weights /= norms[rows]
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def search(self, query: str, k: int = 5, max_subtree_nodes: int = 30) -> list[ViewNode]:
+        query_counts: dict[str, int] = {}
+        for gram in _ngrams(re.sub(r"[^0-9a-zA-Z]+", " ", query).strip().lower(), self._ngram):
+            query_counts[gram] = query_counts.get(gram, 0) + 1
+
+        scores = np.zeros(len(self._nodes), dtype=np.float32)
+        for gram, count in query_counts.items():
+            posting = self._postings.get(gram)
+            if posting is not None:
+                rows, weights = posting
+                scores[rows] += count * self._idf[gram] * weights
+
+        matched = np.flatnonzero(scores > 0)
+        result, chosen = [], []
+        for row in matched[np.argsort(-scores[matched], kind="stable")]:
+            if len(result) == k:
+                break
+            path = self._paths[row]
+            if count_nodes([self._nodes[row]]) > max_subtree_nodes:
+                continue
+            if any(path[:len(other)] == other or other[:len(path)] == path for other in chosen):
+                continue
+            chosen.append(path)
+            result.append(self._nodes[row])
+        return result
@@ -1,5 +1,5 @@
 import logging
-from typing import TypedDict, Annotated
+from typing import TypedDict, Annotated, Optional
 
 from langchain.output_parsers import ResponseSchema, StructuredOutputParser
 from langchain_core.language_models import BaseChatModel
@@ -11,13 +11,20 @@ from langgraph.types import RetryPolicy
 from uiautomator2 import Device
 from uiautomator2.xpath import XPathError
 
-from viewnode import parse_xml_to_tree, ViewNode, without_fields
+from explorer.element_index import ElementIndex
+from explorer.hierarchy_capture import HierarchyCapture, HierarchyDump
+from profiling import span, traced
+from spatial_index import parse_bounds, contains
+from viewnode import ViewNode, without_fields, count_nodes, skeleton
 
 logging.basicConfig(level=logging.INFO)
 
 
 class AgentState(TypedDict):
     hierarchy: list[ViewNode]
+    visible_hierarchy: list[ViewNode]
+    prompt_hierarchy: Optional[dict[str]]
+    position_checked: bool
     element_request: str
     element: dict[str]
     messages: Annotated[list[AnyMessage], add_messages]
@@ -56,11 +63,22 @@ class ElementNavigator:
 
     logger = logging.getLogger(__name__)
 
-    def __init__(self, model: BaseChatModel, device: Device):
+    def __init__(self,
+                 model: BaseChatModel,
+                 device: Device,
+                 retrieval_threshold: int = 150,
+                 top_k: int = 5,
+                 prune_occluded: bool = False):
         self._device = device
         self._model = model
+        self._retrieval_threshold = retrieval_threshold
+        self._top_k = top_k
+        self._prune_occluded = prune_occluded
 
         self.full_hierarchy = ""
+        self._capture = HierarchyCapture.of(device)
+        self._dump: Optional[HierarchyDump] = None
+        self._prefetched_hierarchy: Optional[HierarchyDump] = None
 
         tasks = "1. " + self.screen_name_schema.description
         tasks += "\n2. " + self.screen_description_schema.description
@@ -96,21 +114,39 @@ Elements hierarchy:
                                )
         graph_builder.add_node("get_element_info", self._get_element_info)
         graph_builder.add_node("find_another_xpath", self._find_another_xpath)
+        graph_builder.add_node("find_by_position", self._find_by_position)
 
         graph_builder.add_edge(START, "find_element")
         graph_builder.add_edge("find_element", "get_element_info")
         graph_builder.add_conditional_edges("get_element_info", self._only_one_element_with_this_xpath)
         graph_builder.add_conditional_edges("find_another_xpath", self._only_one_element_with_this_xpath)
+        graph_builder.add_conditional_edges("find_by_position", self._only_one_element_with_this_xpath)
 
         self._graph = graph_builder.compile()
 
+    def prefetch_hierarchy(self):
+        self._prefetched_hierarchy = self._capture.capture()
+
+    def invalidate_hierarchy(self):
+        self._prefetched_hierarchy = None
+
+    def _element_index(self) -> ElementIndex:
+        return self._dump.unoccluded_index if self._prune_occluded else self._dump.visible_index
+
+    @traced(category="node")
     def _find_element(self, state: AgentState) -> AgentState:
-        self.full_hierarchy = self._device.dump_hierarchy(max_depth=100)
-        state["hierarchy"] = parse_xml_to_tree(self.full_hierarchy)
+        if self._prefetched_hierarchy is not None:
+            self._dump, self._prefetched_hierarchy = self._prefetched_hierarchy, None
+        else:
+            self._dump = self._capture.capture()
+        self.full_hierarchy = self._dump.xml
+        state["hierarchy"] = self._dump.tree
+        state["visible_hierarchy"] = self._dump.unoccluded_tree if self._prune_occluded else self._dump.visible_tree
+        state["prompt_hierarchy"] = self._reduce_hierarchy(state["visible_hierarchy"], state["element_request"])
 
         request = self._find_view_prompt_template.invoke({
             "screen_element": state["element_request"],
-            "hierarchy": state["hierarchy"]
+            "hierarchy": state["prompt_hierarchy"] or state["visible_hierarchy"]
         })
         response = self._model.invoke(request)
 
@@ -121,10 +157,22 @@ Elements hierarchy:
             self.logger.warning(state)
             raise LookupError()
 
+    @traced("reduce_hierarchy", "parse")
+    def _reduce_hierarchy(self, hierarchy: list[ViewNode], element_request: str) -> Optional[dict[str]]:
+        if count_nodes(hierarchy) <= self._retrieval_threshold:
+            return None
+
+        candidates = self._element_index().search(element_request, self._top_k)
+        return {
+            "screen_skeleton": skeleton(without_fields(hierarchy, ["bounds"])),
+            "candidate_elements": without_fields(candidates, ["bounds"])
+        }
+
+    @traced(category="node")
     def _get_element_info(self, state: AgentState) -> AgentState:
         state["messages"] = self._return_element_info_prompt_template.invoke({
             "screen_element": state["element_request"],
-            "hierarchy": without_fields(state["hierarchy"], ["bounds"]),
+            "hierarchy": state["prompt_hierarchy"] or without_fields(state["visible_hierarchy"], ["bounds"]),
             "format_instructions": self._output_parser.get_format_instructions()
         }).to_messages()
         response = self._model.invoke(state["messages"])
@@ -132,6 +180,7 @@ Elements hierarchy:
         state["element"] = self._output_parser.parse(response.text())
         return state
 
+    @traced(category="node")
     def _find_another_xpath(self, state: AgentState) -> AgentState:
         state["messages"].append("Come up with another xpath, this one doesn't work. "
                                  "Return only the xpath string in the response!!!")
@@ -140,22 +189,57 @@ Elements hierarchy:
         state["element"]["xpath"] = response.text()
         return state
 
+    @traced(category="node")
+    def _find_by_position(self, state: AgentState) -> AgentState:
+        state["position_checked"] = True
+        candidates = self._element_index().search(state["element_request"], 1)
+        if not candidates:
+            return state
+
+        xpath = state["element"]["xpath"]
+        target = parse_bounds(candidates[0].get("bounds"))
+        if not target:
+            return state
+
+        with span("xpath_all", "parse"):
+            elements = self._device.xpath(xpath, source=self._dump.page_source).all()
+        positions = [
+            position for position, element in enumerate(elements)
+            if contains(tuple(element.bounds), target) or contains(target, tuple(element.bounds))
+        ]
+        if len(positions) == 1:
+            self.logger.info(f"Disambiguated by position {target}")
+            state["element"]["xpath"] = f"({xpath})[{positions[0] + 1}]"
+        return state
+
     def _only_one_element_with_this_xpath(self, state: AgentState) -> str:
         xpath = state["element"]["xpath"]
         try:
-            elements = len(self._device.xpath(xpath).all())
+            with span("xpath_all", "parse"):
+                elements = len(self._device.xpath(xpath, source=self._dump.page_source).all())
         except XPathError:
             elements = 0
 
         if elements == 1:
             self.logger.info(f"'Single element with xpath = {xpath}")
             return END
+        elif elements > 1 and not state.get("position_checked"):
+            return "find_by_position"
         else:
             self.logger.info(f"Retry: {elements} with xpath = {xpath}")
             return "find_another_xpath"
 
+    def is_present(self, request: str) -> bool:
+        try:
+            self._find_element(AgentState(element_request=request))
+            return True
+        except LookupError:
+            return False
+        finally:
+            self._prefetched_hierarchy = self._dump
+
     def find_element_info(self, request: str) -> dict[str]:
         result = self._graph.invoke({
             "element_request": request
         })
-        return {k: v for k, v in result.items() if k != "messages"}
+        return {k: v for k, v in result.items() if k not in ("messages", "visible_hierarchy", "prompt_hierarchy", "position_checked")}
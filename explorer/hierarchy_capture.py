@@ -0,0 +1,129 @@
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from functools import cached_property
+from typing import Any, Optional
+
+from uiautomator2 import Device
+from uiautomator2.xpath import PageSource
+
+from explorer.element_index import ElementIndex
+from profiling import span
+from spatial_index import prune_hidden
+from viewnode import parse_xml_to_tree, ViewNode
+
+
+class HierarchyDump:
+    """Hierarchy dump of one screen state, parsed lazily and at most once"""
+
+    def __init__(self, xml: str, digest: str):
+        self.xml = xml
+        self.digest = digest
+
+    @cached_property
+    def tree(self) -> list[ViewNode]:
+        with span("parse_hierarchy", "parse"):
+            return parse_xml_to_tree(self.xml)
+
+    @cached_property
+    def visible_tree(self) -> list[ViewNode]:
+        with span("prune_hidden", "parse"):
+            return prune_hidden(self.tree)
+
+    @cached_property
+    def unoccluded_tree(self) -> list[ViewNode]:
+        with span("prune_hidden", "parse"):
+            return prune_hidden(self.tree, occlusion=True)
+
+    @cached_property
+    def visible_index(self) -> ElementIndex:
+        with span("build_element_index", "parse"):
+            return ElementIndex(self.visible_tree)
+
+    @cached_property
+    def unoccluded_index(self) -> ElementIndex:
+        with span("build_element_index", "parse"):
+            return ElementIndex(self.unoccluded_tree)
+
+    @cached_property
+    def page_source(self) -> PageSource:
+        return PageSource(self.xml)
+
+
+class HierarchyCapture:
+    """Per-device hierarchy dumps: reuses the parsed dump while the screen is unchanged,
+    keeps a bounded history of recent dumps and collects dump latency stats"""
+
+    _captures: dict[str, "HierarchyCapture"] = {}
+    _captures_lock = threading.Lock()
+
+    def __init__(self, device: Device, max_depth: int = 100, compressed: bool = False, history_size: int = 20):
+        self.device = device
+        self._max_depth = max_depth
+        self._compressed = compressed
+        self._lock = threading.Lock()
+        self._history: deque[tuple[float, float, HierarchyDump]] = deque(maxlen=history_size)
+        self._latencies: deque[float] = deque(maxlen=1000)
+        self._stats = {"captures": 0, "unchanged": 0}
+        self.last: Optional[HierarchyDump] = None
+
+    @classmethod
+    def of(cls, device: Device) -> "HierarchyCapture":
+        key = getattr(device, "serial", None) or str(id(device))
+        with cls._captures_lock:
+            capture = cls._captures.get(key)
+            if capture is None:
+                capture = cls._captures[key] = cls(device)
+            capture.device = device
+            return capture
+
+    @classmethod
+    def stats_by_device(cls) -> dict[str, dict[str, Any]]:
+        with cls._captures_lock:
+            captures = dict(cls._captures)
+        return {key: capture.stats() for key, capture in captures.items()}
+
+    def capture(self) -> HierarchyDump:
+        started = time.perf_counter()
+        with span("dump_hierarchy", "device"):
+            xml = self.device.dump_hierarchy(compressed=self._compressed, max_depth=self._max_depth)
+        latency = time.perf_counter() - started
+        digest = hashlib.blake2b(xml.encode("utf-8"), digest_size=16).hexdigest()
+
+        with self._lock:
+            self._stats["captures"] += 1
+            self._latencies.append(latency)
+            if self.last is not None and self.last.digest == digest:
+                self._stats["unchanged"] += 1
+            else:
+                self.last = HierarchyDump(xml, digest)
+            self._history.append((time.time(), latency, self.last))
+            return self.last
+
+    @property
+    def history(self) -> list[HierarchyDump]:
+        with self._lock:
+            return [dump for _, _, dump in self._history]
+
+    def save_history(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            history = list(self._history)
+        for captured_at, _, dump in history:
+            with open(os.path.join(directory, f"{captured_at:.3f}-{dump.digest[:8]}.xml"), "w", encoding="utf-8") as f:
+                f.write(dump.xml)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = dict(self._stats)
+        if latencies:
+            stats.update({
+                "latency_mean": sum(latencies) / len(latencies),
+                "latency_p50": latencies[len(latencies) // 2],
+                "latency_p95": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+                "latency_max": latencies[-1]
+            })
+        return stats
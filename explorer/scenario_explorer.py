@@ -1,19 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from time import sleep
-from typing import Optional, List, TypedDict
+from typing import Optional, List, TypedDict, Iterator
 
 import uiautomator2
 from langchain_core.language_models import BaseChatModel
-from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import PromptTemplate
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.constants import START
 from langgraph.graph import StateGraph
 from pydantic import BaseModel, Field
 from uiautomator2 import XPathElementNotFoundError
 
 from action_frame import ActionFrame
+from checkpoints import invoke_resumable, run_config
+from explorer.crawler import AppCrawler
 from explorer.element_navigator import ElementNavigator
-from utils import get_file_content
+from explorer.screen_graph import ScreenGraph
+from profiling import span, traced
+from structured_output import RepairingOutputParser
+from utils import get_prompt
 
 
 class ActionType(str, Enum):
@@ -35,6 +41,7 @@ class Scenario(BaseModel):
 
 class ExplorerState(TypedDict):
     user_request: str
+    start_screen: Optional[str]
     user_scenario: Scenario
     actual_scenario: Scenario
     trace: list[ActionFrame]
@@ -42,7 +49,10 @@ class ExplorerState(TypedDict):
 
 class ScenarioExplorer:
 
-    def __init__(self, model: BaseChatModel):
+    def __init__(self,
+                 model: BaseChatModel,
+                 checkpointer: Optional[BaseCheckpointSaver] = None,
+                 screen_graph: Optional[ScreenGraph] = None):
         graph_builder = StateGraph(ExplorerState)
         graph_builder.add_node("extract_scenario", self._extract_scenario)
         graph_builder.add_node("explore", self._explore)
@@ -50,12 +60,14 @@ class ScenarioExplorer:
         graph_builder.add_edge(START, "extract_scenario")
         graph_builder.add_edge("extract_scenario", "explore")
 
-        self._graph = graph_builder.compile()
+        self._graph = graph_builder.compile(checkpointer=checkpointer)
         self._model = model
+        self._screen_graph = screen_graph
 
+    @traced(category="node")
     def _extract_scenario(self, state: ExplorerState) -> ExplorerState:
-        parser = PydanticOutputParser(pydantic_object=Scenario)
-        request = PromptTemplate.from_template(get_file_content("./explorer/prompts/extract_step_by_step_scenario.md")).invoke({
+        parser = RepairingOutputParser(Scenario, self._model)
+        request = PromptTemplate.from_template(get_prompt("./explorer/prompts/extract_step_by_step_scenario.md")).invoke({
             "scenario": state["user_request"],
             "format_instructions": parser.get_format_instructions()
         })
@@ -63,45 +75,77 @@ class ScenarioExplorer:
         state["user_scenario"] = parser.parse(response.text())
         return state
 
+    @traced(category="node")
     def _explore(self, state: ExplorerState) -> ExplorerState:
         device = uiautomator2.connect()
+        self._go_to_start_screen(device, state.get("start_screen"))
         element_navigator = ElementNavigator(self._model, device)
-        state["trace"] = []
+        state["trace"] = list(self._explore_steps(state["user_scenario"], device, element_navigator))
+        return state
 
-        for step in state["user_scenario"].steps:
-            try:
-                element_info = element_navigator.find_element_info(step.element)
+    def _go_to_start_screen(self, device: uiautomator2.Device, start_screen: Optional[str]):
+        if start_screen and self._screen_graph:
+            if not AppCrawler(device, self._screen_graph).go_to(start_screen):
+                raise LookupError(f"Screen {start_screen} is unreachable")
+
+    @staticmethod
+    def _explore_steps(scenario: Scenario,
+                       device: uiautomator2.Device,
+                       element_navigator: ElementNavigator) -> Iterator[ActionFrame]:
+        try:
+            for step in scenario.steps:
                 try:
-                    selector = device.xpath(element_info["element"]["xpath"])
-
-                    if step.action is ActionType.TEXT_INPUT:
-                        selector.click()
-                        sleep(3)
-                        device.send_keys(step.data)
-                        action = ActionFrame(element=element_info, type=step.action, data=step.data)
-                    else:
-                        selector.click()
-                        action = ActionFrame(element=element_info, type=step.action, data=None)
-
-                    state["trace"].append(action)
-                except XPathElementNotFoundError:
-                    interruption = ActionFrame(
-                        element=element_info, type="INTERRUPTION", data="XPathElementNotFoundError"
+                    with span("find_element", "step", element=step.element):
+                        element_info = element_navigator.find_element_info(step.element)
+                    try:
+                        selector = device.xpath(element_info["element"]["xpath"])
+
+                        with span("click", "device"):
+                            selector.click()
+                        if step.action is ActionType.TEXT_INPUT:
+                            with span("sleep", "device"):
+                                sleep(3)
+                            with span("send_keys", "device"):
+                                device.send_keys(step.data)
+                            action = ActionFrame(element=element_info, type=step.action, data=step.data)
+                        else:
+                            action = ActionFrame(element=element_info, type=step.action, data=None)
+
+                        yield action
+                    except XPathElementNotFoundError:
+                        yield ActionFrame(
+                            element=element_info, type="INTERRUPTION", data="XPathElementNotFoundError"
+                        )
+                        break
+                except LookupError:
+                    element_info = {"hierarchy": element_navigator.full_hierarchy, "element_request": step.element}
+                    yield ActionFrame(
+                        element=element_info, type="INTERRUPTION", data="ElementNotFoundError"
                     )
-                    state["trace"].append(interruption)
-                    break
-            except LookupError:
-                element_info = {"hierarchy": element_navigator.full_hierarchy, "element_request": step.element}
-                interruption = ActionFrame(
-                    element=element_info, type="INTERRUPTION", data="ElementNotFoundError"
-                )
-                state["trace"].append(interruption)
-
-        device.stop_uiautomator()
-        return state
-
-    def explore(self, request: str) -> list[ActionFrame]:
-        result = self._graph.invoke({
-            "user_request": request
-        })
-        return result["trace"]
\ No newline at end of file
+        finally:
+            device.stop_uiautomator()
+
+    def explore(self,
+                request: str,
+                thread_id: Optional[str] = None,
+                start_screen: Optional[str] = None) -> list[ActionFrame]:
+        result = invoke_resumable(self._graph, {
+            "user_request": request,
+            "start_screen": start_screen
+        }, run_config(thread_id))
+        return result["trace"]
+
+    def explore_stream(self, request: str, start_screen: Optional[str] = None) -> Iterator[ActionFrame]:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            scenario_future = executor.submit(self._extract_scenario, ExplorerState(user_request=request))
+            device = uiautomator2.connect()
+            try:
+                self._go_to_start_screen(device, start_screen)
+                element_navigator = ElementNavigator(self._model, device)
+                element_navigator.prefetch_hierarchy()
+                state = scenario_future.result()
+            except BaseException:
+                device.stop_uiautomator()
+                raise
+
+        yield from self._explore_steps(state["user_scenario"], device, element_navigator)
\ No newline at end of file
@@ -0,0 +1,80 @@
+import json
+from collections import defaultdict, deque
+from typing import Optional, TypedDict
+
+from action_frame import ActionFrame
+
+
+class Screen(TypedDict):
+    activity: str
+    texts: list[str]
+    elements: list[dict[str]]
+
+
+class Transition(TypedDict):
+    target: str
+    action: ActionFrame
+
+
+class ScreenGraph:
+
+    def __init__(self):
+        self.root: Optional[str] = None
+        self.screens: dict[str, Screen] = {}
+        self.transitions: dict[str, list[Transition]] = defaultdict(list)
+
+    def add_screen(self, screen_id: str, screen: Screen) -> bool:
+        if screen_id in self.screens:
+            return False
+        self.screens[screen_id] = screen
+        return True
+
+    def add_transition(self, source: str, target: str, action: ActionFrame):
+        if not any(transition["target"] == target for transition in self.transitions[source]):
+            self.transitions[source].append(Transition(target=target, action=action))
+
+    def shortest_path(self, source: str, target: str) -> Optional[list[ActionFrame]]:
+        previous: dict[str, Optional[tuple[str, ActionFrame]]] = {source: None}
+        queue = deque([source])
+
+        while queue:
+            screen_id = queue.popleft()
+            if screen_id == target:
+                path = []
+                while previous[screen_id] is not None:
+                    screen_id, action = previous[screen_id]
+                    path.append(action)
+                return path[::-1]
+
+            for transition in self.transitions.get(screen_id, []):
+                if transition["target"] not in previous:
+                    previous[transition["target"]] = (screen_id, transition["action"])
+                    queue.append(transition["target"])
+
+        return None
+
+    def find_screens(self, query: str) -> list[str]:
+        query = query.lower()
+        return [
+            screen_id for screen_id, screen in self.screens.items()
+            if query in screen["activity"].lower() or any(query in text.lower() for text in screen["texts"])
+        ]
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "root": self.root,
+                "screens": self.screens,
+                "transitions": self.transitions
+            }))
+
+    @classmethod
+    def load(cls, path: str) -> "ScreenGraph":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.loads(f.read())
+
+        graph = cls()
+        graph.root = data["root"]
+        graph.screens = data["screens"]
+        graph.transitions.update(data["transitions"])
+        return graph
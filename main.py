@@ -1,46 +1,209 @@
+import argparse
 import json
+import logging
 import os
+import uuid
+from functools import lru_cache
+from typing import Optional, TYPE_CHECKING
 
-from langchain_anthropic import ChatAnthropic
-
-from coder.automator import Automator
-from coder.builder import GradleBuildAgent
-from explorer.scenario_explorer import ScenarioExplorer
+from profiling import span, enable_profiling
 from utils import get_file_content
 
-model = ChatAnthropic(
-    model_name="claude-3-7-sonnet-latest",
-    # model_name="claude-3-5-haiku-latest",
-    api_key=get_file_content(".anthropic_token"),
-    temperature=0.0,
-    max_tokens=40_000
-)
+if TYPE_CHECKING:
+    from langchain_core.language_models import BaseChatModel
+    from coder.kotlinfile import UITestsKotlinFile
+    from explorer.screen_graph import ScreenGraph
+    from scheduler import LLMScheduler
+
+
+@lru_cache(maxsize=None)
+def get_scheduler(requests_per_minute: int = 50, tokens_per_minute: int = 40_000) -> "LLMScheduler":
+    from langchain_anthropic import ChatAnthropic
+    from scheduler import LLMScheduler
+
+    return LLMScheduler(ChatAnthropic(
+        model_name="claude-3-7-sonnet-latest",
+        # model_name="claude-3-5-haiku-latest",
+        api_key=get_file_content(".anthropic_token"),
+        temperature=0.0,
+        max_tokens=40_000,
+        max_retries=0
+    ), requests_per_minute, tokens_per_minute)
+
+
+def get_background_model(**limits) -> "BaseChatModel":
+    from scheduler import Priority
+
+    return get_scheduler(**limits).chat_model(Priority.BACKGROUND)
+
+
+def get_models():
+    from scheduler import Priority
+
+    scheduler = get_scheduler()
+    return scheduler.chat_model(Priority.INTERACTIVE), scheduler.chat_model(Priority.BACKGROUND)
+
 
 request = """
 Enter "example" in the task name field. Click 'Add'. Tap on the task delete button
 """
 
 
-def launch_agent(record_trace=False):
-    if record_trace:
-        explorer = ScenarioExplorer(model)
-        trace = explorer.explore(request)
-        with open("data.json", "w", encoding="utf-8") as f:
-            f.write(json.dumps(trace))
-    else:
-        trace = json.loads(get_file_content("data.json"))
+def write_source(code_file: "UITestsKotlinFile"):
+    file_path = "example/app/src/androidTest/java/verterai/example/" + code_file.relative_filepath
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(code_file.source)
 
-    automator = Automator(model)
-    source_code = automator.code(request, trace)
 
+def write_sources(source_code: list["UITestsKotlinFile"]):
     for code_file in source_code:
-        file_path = "example/app/src/androidTest/java/verterai/example/" + code_file.relative_filepath
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(code_file.source)
+        write_source(code_file)
+
+
+def load_screen_graph(screen_graph_path: str = "screens.json") -> Optional["ScreenGraph"]:
+    from explorer.screen_graph import ScreenGraph
+
+    return ScreenGraph.load(screen_graph_path) if os.path.exists(screen_graph_path) else None
+
+
+def find_start_screen(screen_graph: Optional["ScreenGraph"], query: Optional[str]) -> Optional[str]:
+    if not query:
+        return None
+    if screen_graph is None:
+        raise LookupError("No screens.json, crawl the app with --crawl first")
+    if query in screen_graph.screens:
+        return query
+
+    screens = screen_graph.find_screens(query)
+    if not screens:
+        raise LookupError(f"No crawled screen matches '{query}'")
+    return screens[0]
+
+
+def launch_agent(record_trace=False, run_id: Optional[str] = None, stream=False, start_screen: Optional[str] = None):
+    from checkpoints import sqlite_checkpointer, save_run_options, load_run_options
+    from coder.automator import Automator
+    from coder.builder import GradleBuildAgent
+    from explorer.hierarchy_capture import HierarchyCapture
+    from explorer.scenario_explorer import ScenarioExplorer
+
+    interactive_model, model = get_models()
+    checkpointer = sqlite_checkpointer()
+    options = load_run_options(checkpointer, run_id) if run_id else None
+    if options is not None:
+        record_trace, stream, start_screen = options["record"], options["stream"], options["start_screen"]
+    elif run_id:
+        logging.warning(f"No saved options for run {run_id}, using the command line ones")
+
+    run_id = run_id or str(uuid.uuid4())
+    save_run_options(checkpointer, run_id, {"record": record_trace, "stream": stream, "start_screen": start_screen})
+    logging.info(f"Run id: {run_id}, resume with `python main.py --resume {run_id}`")
+
+    with span("scenario", "scenario", run_id=run_id):
+        if record_trace:
+            with span("explore", "phase"):
+                screen_graph = load_screen_graph()
+                explorer = ScenarioExplorer(interactive_model, checkpointer, screen_graph)
+                trace = explorer.explore(request, thread_id=f"{run_id}-explore",
+                                         start_screen=find_start_screen(screen_graph, start_screen))
+            with open("data.json", "w", encoding="utf-8") as f:
+                f.write(json.dumps(trace))
+            logging.info(f"Hierarchy dumps: {HierarchyCapture.stats_by_device()}")
+        else:
+            trace = json.loads(get_file_content("data.json"))
+
+        with span("code", "phase"):
+            automator = Automator(model, checkpointer, file_sink=write_source if stream else None)
+            source_code = automator.code(request, trace, thread_id=f"{run_id}-code")
+            write_sources(source_code)
+
+        with span("build", "phase"):
+            GradleBuildAgent("example/", model, checkpointer).build_and_fix(thread_id=f"{run_id}-build")
+    logging.info(f"LLM scheduler: {get_scheduler().metrics()}")
+
+
+def launch_pipelined_agent(start_screen: Optional[str] = None):
+    from coder.automator import Automator
+    from coder.builder import GradleBuildAgent
+    from explorer.scenario_explorer import ScenarioExplorer
+
+    interactive_model, model = get_models()
+    screen_graph = load_screen_graph()
+    explorer = ScenarioExplorer(interactive_model, screen_graph=screen_graph)
+    trace = []
+
+    def recorded(frames):
+        for frame in frames:
+            trace.append(frame)
+            yield frame
+
+    automator = Automator(model)
+    try:
+        source_code = automator.code_stream(request, recorded(
+            explorer.explore_stream(request, find_start_screen(screen_graph, start_screen))
+        ))
+    finally:
+        with open("data.json", "w", encoding="utf-8") as f:
+            f.write(json.dumps(trace))
+    write_sources(source_code)
 
     GradleBuildAgent("example/", model).build_and_fix()
 
 
+def launch_batch_agent(scenarios: list[tuple[str, str]], build_workers: int = 2):
+    from coder.automator import Automator
+    from coder.build_pool import BuildPool
+
+    batch = [
+        (scenario_request, json.loads(get_file_content(trace_path)))
+        for scenario_request, trace_path in scenarios
+    ]
+
+    automator = Automator(get_background_model())
+    source_code = automator.code_batch(batch)
+
+    result = BuildPool("example/", get_background_model, workers=build_workers).verify(source_code)
+    logging.info(f"Build successful: {result['successful']}, fixed files: {len(result['files'])}")
+
+
+def crawl_app(screen_graph_path: str = "screens.json"):
+    import uiautomator2
+    from explorer.crawler import AppCrawler
+
+    screen_graph = load_screen_graph(screen_graph_path)
+    device = uiautomator2.connect()
+    try:
+        screen_graph = AppCrawler(device, screen_graph).crawl()
+    finally:
+        device.stop_uiautomator()
+
+    screen_graph.save(screen_graph_path)
+    logging.info(f"Screens: {len(screen_graph.screens)}")
+
+
 if __name__ == '__main__':
-    launch_agent(record_trace=False)
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", action="store_true", help="Record a new trace on the device")
+    parser.add_argument("--resume", metavar="RUN_ID", help="Resume an interrupted run from its checkpoints")
+    parser.add_argument("--crawl", action="store_true", help="Crawl the running app into screens.json")
+    parser.add_argument("--start-screen", metavar="SCREEN",
+                        help="Crawled screen id, activity or text to navigate to before recording")
+    parser.add_argument("--stream", action="store_true", help="Stream generated files to disk as they are ready")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Record a new trace and generate code from its steps while recording")
+    parser.add_argument("--profile", metavar="PATH", nargs="?", const="profile.json",
+                        help="Write Chrome trace events and a per-phase summary on exit")
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling(args.profile)
+
+    if args.crawl:
+        crawl_app()
+    elif args.pipelined:
+        launch_pipelined_agent(start_screen=args.start_screen)
+    else:
+        launch_agent(record_trace=args.record, run_id=args.resume, stream=args.stream, start_screen=args.start_screen)
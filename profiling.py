@@ -0,0 +1,134 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+
+class Profiler:
+    """Collects nested timing spans per thread and exports them as Chrome trace events
+    (chrome://tracing, Perfetto, speedscope) or as an aggregated per-phase table"""
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self.enabled = False
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._events: list[dict[str, Any]] = []
+        self._totals: dict[tuple[str, str], list[float]] = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+
+    def reset(self):
+        with self._lock:
+            self._origin = time.perf_counter()
+            self._events.clear()
+            self._totals.clear()
+
+    @contextmanager
+    def span(self, name: str, category: str = "app", **args) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            children = stack.pop()
+            if stack:
+                stack[-1] += duration
+            self._record(name, category, started, duration, duration - children, args)
+
+    def traced(self, name: Optional[str] = None, category: str = "app") -> Callable:
+        def decorator(function: Callable) -> Callable:
+            span_name = name or function.__name__.lstrip("_")
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name, category):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def _record(self, name: str, category: str, started: float, duration: float, self_time: float, args: dict):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((started - self._origin) * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident()
+        }
+        if args:
+            event["args"] = {key: str(value) for key, value in args.items()}
+
+        with self._lock:
+            self._events.append(event)
+            totals = self._totals[(category, name)]
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] += self_time
+            totals[3] = max(totals[3], duration)
+
+    def trace_events(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return list(self._events)
+
+    def export_chrome(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
+
+    def summary(self) -> list[dict[str, Any]]:
+        with self._lock:
+            rows = [
+                {"category": category, "name": name, "calls": calls, "total": total, "self": self_time,
+                 "mean": total / calls, "max": longest}
+                for (category, name), (calls, total, self_time, longest) in self._totals.items()
+            ]
+        return sorted(rows, key=lambda row: row["self"], reverse=True)
+
+    def format_summary(self) -> str:
+        rows = self.summary()
+        phases: dict[str, float] = defaultdict(float)
+        for row in rows:
+            phases[row["category"]] += row["self"]
+
+        lines = [f"{'category':<12}{'name':<32}{'calls':>7}{'total s':>10}{'self s':>10}{'mean ms':>10}{'max ms':>10}"]
+        lines += [
+            f"{row['category']:<12}{row['name'][:31]:<32}{row['calls']:>7}{row['total']:>10.2f}{row['self']:>10.2f}"
+            f"{row['mean'] * 1000:>10.1f}{row['max'] * 1000:>10.1f}"
+            for row in rows
+        ]
+        lines.append("")
+        lines += [f"{category:<12}{self_time:>10.2f} s" for category, self_time in
+                  sorted(phases.items(), key=lambda item: item[1], reverse=True)]
+        return "\n".join(lines)
+
+
+profiler = Profiler()
+span = profiler.span
+traced = profiler.traced
+
+
+def enable_profiling(path: str = "profile.json"):
+    """Turns on the global profiler and writes the trace and the summary on exit"""
+
+    def report():
+        profiler.export_chrome(path)
+        Profiler._logger.info(f"Profile saved to {path}\n{profiler.format_summary()}")
+
+    profiler.reset()
+    profiler.enabled = True
+    atexit.register(report)
@@ -0,0 +1,230 @@
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from enum import IntEnum
+from typing import Any, Optional, Callable, Iterator
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
+
+from profiling import span
+from utils import estimate_tokens
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class LLMScheduler:
+    """Process-wide gate for model calls with requests/tokens per minute budgets"""
+
+    _logger = logging.getLogger(__name__)
+    _window = 60.0
+
+    def __init__(self,
+                 model: BaseChatModel,
+                 requests_per_minute: int = 50,
+                 tokens_per_minute: int = 40_000,
+                 max_retries: int = 5,
+                 clock: Callable[[], float] = time.monotonic,
+                 wait: Callable[[threading.Condition, Optional[float]], Any] = threading.Condition.wait):
+        self.model = model
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+        self._max_retries = max_retries
+        self._clock = clock
+        self._wait = wait
+
+        self._condition = threading.Condition()
+        self._queue: list[tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self._usage: deque[tuple[float, int, int]] = deque()
+        self._paused_until = 0.0
+        self._in_flight: dict[str, Future] = {}
+        self._stats = {"requests": 0, "coalesced": 0, "rate_limited": 0, "wait_seconds": 0.0}
+
+    def chat_model(self, priority: Priority = Priority.BACKGROUND) -> "ScheduledChatModel":
+        return ScheduledChatModel(scheduler=self, priority=priority)
+
+    def invoke(self, messages: list[BaseMessage], priority: Priority, **kwargs) -> BaseMessage:
+        key = self._request_key(messages, kwargs)
+        with self._condition:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._stats["coalesced"] += 1
+
+        if owner:
+            try:
+                future.set_result(self._invoke_scheduled(messages, priority, kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._in_flight.pop(key, None)
+
+        return future.result()
+
+    def stream(self, messages: list[BaseMessage], priority: Priority, **kwargs) -> Iterator[BaseMessageChunk]:
+        tokens = estimate_tokens("".join(str(message.content) for message in messages))
+
+        for attempt in range(self._max_retries + 1):
+            with span("queue", "llm"):
+                self._acquire(priority, tokens)
+            response = None
+            try:
+                with span("stream", "llm", priority=priority.name, tokens=tokens):
+                    for chunk in self.model.stream(messages, **kwargs):
+                        response = chunk if response is None else response + chunk
+                        yield chunk
+            except Exception as e:
+                # chunks already handed out can't be taken back, so only retry before the first one
+                if response is not None or not self._is_rate_limit(e) or attempt == self._max_retries:
+                    raise
+                self._pause(e, attempt)
+                continue
+
+            self._record_usage(response, tokens)
+            return
+
+    def metrics(self) -> dict[str, Any]:
+        with self._condition:
+            now = self._clock()
+            window = [(requests, tokens) for ts, requests, tokens in self._usage if now - ts < self._window]
+            return {
+                "queue_depth": {
+                    priority.name.lower(): sum(1 for queued, _ in self._queue if queued == priority)
+                    for priority in Priority
+                },
+                "in_flight": len(self._in_flight),
+                "window_requests": sum(requests for requests, _ in window),
+                "window_tokens": sum(tokens for _, tokens in window),
+                **self._stats
+            }
+
+    @staticmethod
+    def _request_key(messages: list[BaseMessage], kwargs: dict) -> str:
+        payload = json.dumps(
+            [[message.type, message.content] for message in messages] + [kwargs],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _invoke_scheduled(self, messages: list[BaseMessage], priority: Priority, kwargs: dict) -> BaseMessage:
+        tokens = estimate_tokens("".join(str(message.content) for message in messages))
+
+        for attempt in range(self._max_retries + 1):
+            with span("queue", "llm"):
+                self._acquire(priority, tokens)
+            try:
+                with span("invoke", "llm", priority=priority.name, tokens=tokens):
+                    response = self.model.invoke(messages, **kwargs)
+            except Exception as e:
+                if not self._is_rate_limit(e) or attempt == self._max_retries:
+                    raise
+                self._pause(e, attempt)
+                continue
+
+            self._record_usage(response, tokens)
+            return response
+
+    def _record_usage(self, response: Optional[BaseMessage], tokens: int):
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            with self._condition:
+                self._usage.append((self._clock(), 0, usage["total_tokens"] - tokens))
+
+    def _acquire(self, priority: Priority, tokens: int):
+        started = self._clock()
+        with self._condition:
+            entry = (int(priority), next(self._sequence))
+            heapq.heappush(self._queue, entry)
+            while True:
+                delay = self._delay(tokens) if self._queue[0] == entry else None
+                if delay == 0:
+                    break
+                self._wait(self._condition, delay)
+
+            heapq.heappop(self._queue)
+            self._usage.append((self._clock(), 1, tokens))
+            self._stats["requests"] += 1
+            self._stats["wait_seconds"] += self._clock() - started
+            self._condition.notify_all()
+
+    def _delay(self, tokens: int) -> float:
+        now = self._clock()
+        while self._usage and now - self._usage[0][0] >= self._window:
+            self._usage.popleft()
+
+        if now < self._paused_until:
+            return self._paused_until - now
+        if not self._usage:
+            return 0
+
+        requests = sum(requests for _, requests, _ in self._usage)
+        used_tokens = sum(tokens for _, _, tokens in self._usage)
+        if requests < self._requests_per_minute and used_tokens + tokens <= self._tokens_per_minute:
+            return 0
+        return max(self._usage[0][0] + self._window - now, 0.01)
+
+    @staticmethod
+    def _is_rate_limit(error: Exception) -> bool:
+        return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+    def _pause(self, error: Exception, attempt: int):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        delay = float(retry_after) if retry_after else 2.0 ** attempt
+
+        with self._condition:
+            self._stats["rate_limited"] += 1
+            self._paused_until = max(self._paused_until, self._clock() + delay)
+            self._condition.notify_all()
+        self._logger.warning(f"Rate limited, pause for {delay}s")
+
+
+class ScheduledChatModel(BaseChatModel):
+    """Chat model facade that routes every call through LLMScheduler with fixed priority"""
+
+    scheduler: LLMScheduler
+    priority: Priority = Priority.BACKGROUND
+
+    @property
+    def _llm_type(self) -> str:
+        return "scheduled"
+
+    def _generate(self,
+                  messages: list[BaseMessage],
+                  stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None,
+                  **kwargs: Any) -> ChatResult:
+        if stop:
+            kwargs["stop"] = stop
+        message = self.scheduler.invoke(messages, self.priority, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self,
+                messages: list[BaseMessage],
+                stop: Optional[list[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        if stop:
+            kwargs["stop"] = stop
+        for chunk in self.scheduler.stream(messages, self.priority, **kwargs):
+            yield ChatGenerationChunk(message=chunk)
+
+    def bind_tools(self, tools, **kwargs):
+        binding = self.scheduler.model.bind_tools(tools, **kwargs)
+        return self.bind(**binding.kwargs)
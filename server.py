@@ -1,12 +1,19 @@
+import argparse
 import os
+from functools import lru_cache
 from time import sleep
+from typing import TYPE_CHECKING, Optional, Literal
 
-import uiautomator2
-from langchain_anthropic import ChatAnthropic
 from mcp.server.fastmcp import FastMCP
-from uiautomator2 import XPathElementNotFoundError
+from pydantic import BaseModel, Field, model_validator
 
-from explorer.element_navigator import ElementNavigator
+from action_frame import ActionFrame
+from profiling import span, enable_profiling
+
+if TYPE_CHECKING:
+    import uiautomator2
+    from langchain_core.language_models import BaseChatModel
+    from explorer.element_navigator import ElementNavigator
 
 
 class ElementNotFoundException(Exception):
@@ -15,35 +22,114 @@ class ElementNotFoundException(Exception):
         self.context_data = context_data
 
 
+class BatchStep(BaseModel):
+    """Model of a single step of the actions batch"""
+    action: Literal["click", "text_input", "wait", "assert_present"] = Field(description="Step type")
+    element: Optional[str] = Field(None, description="Description of the element, for all steps except 'wait'")
+    data: Optional[str] = Field(None, description="Text for 'text_input' or, for 'wait', the maximum seconds "
+                                                  "to wait for the device to become idle (3 by default)")
+
+    @model_validator(mode="after")
+    def _check_fields(self) -> "BatchStep":
+        if self.action != "wait" and not self.element:
+            raise ValueError(f"'{self.action}' step requires 'element'")
+        if self.action == "text_input" and self.data is None:
+            raise ValueError("'text_input' step requires 'data' with the text")
+        if self.action == "wait" and self.data is not None:
+            try:
+                float(self.data)
+            except ValueError:
+                raise ValueError(f"'wait' step requires numeric 'data' seconds, got '{self.data}'")
+        return self
+
+
 mcp = FastMCP("Emulator clicker")
-model = ChatAnthropic(
-    model_name="claude-3-5-haiku-latest",
-    api_key=os.getenv('API_KEY')
-)
 
 
-def click_on(device: uiautomator2.Device, screen_element_description: str) -> dict[str]:
-    element_navigator = ElementNavigator(model, device)
+@lru_cache(maxsize=None)
+def get_model() -> "BaseChatModel":
+    from langchain_anthropic import ChatAnthropic
+    from scheduler import LLMScheduler, Priority
+
+    return LLMScheduler(ChatAnthropic(
+        model_name="claude-3-5-haiku-latest",
+        api_key=os.getenv('API_KEY'),
+        max_retries=0
+    )).chat_model(Priority.INTERACTIVE)
+
+
+def connect() -> "uiautomator2.Device":
+    import uiautomator2
+
+    return uiautomator2.connect()
+
+
+def click_on(device: "uiautomator2.Device",
+             screen_element_description: str,
+             element_navigator: Optional["ElementNavigator"] = None) -> dict[str]:
+    from uiautomator2 import XPathElementNotFoundError
+    from explorer.element_navigator import ElementNavigator
+
+    element_navigator = element_navigator or ElementNavigator(get_model(), device)
     element_info = element_navigator.find_element_info(screen_element_description)
 
     if element_info.get("element"):
         try:
-            device.xpath(element_info["xpath"]).click()
+            with span("click", "device"):
+                device.xpath(element_info["element"]["xpath"]).click()
             return element_info
         except XPathElementNotFoundError:
             raise ElementNotFoundException(
-                f"'{screen_element_description}' not found by {element_info["xpath"]}",
+                f"'{screen_element_description}' not found by {element_info["element"]["xpath"]}",
                 context_data=element_info)
     else:
         raise ElementNotFoundException(
-            f"'{screen_element_description}' not found by {element_info["xpath"]}",
+            f"'{screen_element_description}' not found",
             context_data=element_info)
 
 
+def wait_idle(device: "uiautomator2.Device", timeout: float = 3.0):
+    with span("wait_idle", "device"):
+        device.jsonrpc.waitForIdle(int(timeout * 1000))
+
+
+def run_step(device: "uiautomator2.Device", element_navigator: "ElementNavigator", step: BatchStep) -> ActionFrame:
+    with span(step.action, "step", element=step.element):
+        frame = _run_step(device, element_navigator, step)
+    if step.action != "assert_present":
+        element_navigator.invalidate_hierarchy()
+    return frame
+
+
+def _run_step(device: "uiautomator2.Device", element_navigator: "ElementNavigator", step: BatchStep) -> ActionFrame:
+    if step.action == "wait":
+        wait_idle(device, float(step.data or 3))
+        return ActionFrame(element={}, type=step.action, data=step.data)
+
+    if step.action == "assert_present":
+        if element_navigator.is_present(step.element):
+            return ActionFrame(element={"element_request": step.element}, type=step.action, data=None)
+        return ActionFrame(element={"element_request": step.element}, type="INTERRUPTION",
+                           data="ElementNotFoundError")
+
+    try:
+        element_info = click_on(device, step.element, element_navigator)
+    except (LookupError, ElementNotFoundException) as e:
+        return ActionFrame(element={"element_request": step.element}, type="INTERRUPTION", data=str(e))
+
+    wait_idle(device)
+    if step.action == "text_input":
+        with span("send_keys", "device"):
+            device.send_keys(step.data)
+        wait_idle(device)
+    element_info = {k: v for k, v in element_info.items() if k != "hierarchy"}
+    return ActionFrame(element=element_info, type=step.action, data=step.data)
+
+
 @mcp.tool()
 def click_on_element_with_description(screen_element_description: str) -> dict[str]:
     """Click on element with description"""
-    device = uiautomator2.connect()
+    device = connect()
     try:
         return click_on(device, screen_element_description)
     finally:
@@ -53,7 +139,7 @@ def click_on_element_with_description(screen_element_description: str) -> dict[s
 @mcp.tool()
 def input_text_at_element_with_description(screen_element_description: str, text_for_input: str):
     """Input text at element with description"""
-    device = uiautomator2.connect()
+    device = connect()
     try:
         click_on_element_with_description(screen_element_description)
         sleep(3)
@@ -62,5 +148,31 @@ def input_text_at_element_with_description(screen_element_description: str, text
         device.stop_uiautomator()
 
 
+@mcp.tool()
+def run_steps(steps: list[BatchStep]) -> list[ActionFrame]:
+    """Run ordered steps (click, text_input, wait, assert_present) in one device session,
+    stops at the first failed step and returns the trace of executed steps"""
+    from explorer.element_navigator import ElementNavigator
+
+    device = connect()
+    element_navigator = ElementNavigator(get_model(), device)
+    trace = []
+    try:
+        for step in steps:
+            trace.append(run_step(device, element_navigator, step))
+            if trace[-1]["type"] == "INTERRUPTION":
+                break
+    finally:
+        device.stop_uiautomator()
+    return trace
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", metavar="PATH", nargs="?", const="profile.json",
+                        help="Write Chrome trace events and a per-phase summary on exit")
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling(args.profile)
     mcp.run(transport="stdio")
@@ -0,0 +1,128 @@
+import re
+from collections import defaultdict
+from typing import Optional, Iterator
+
+from viewnode import ViewNode
+
+Bounds = tuple[int, int, int, int]
+
+_bounds_pattern = re.compile(r"\[(-?\d+),(-?\d+)]\[(-?\d+),(-?\d+)]")
+
+
+def parse_bounds(bounds: Optional[str]) -> Optional[Bounds]:
+    match = _bounds_pattern.fullmatch(bounds or "")
+    return tuple(int(value) for value in match.groups()) if match else None
+
+
+def area(bounds: Bounds) -> int:
+    return max(bounds[2] - bounds[0], 0) * max(bounds[3] - bounds[1], 0)
+
+
+def intersects(a: Bounds, b: Bounds) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def contains(outer: Bounds, inner: Bounds) -> bool:
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def screen_bounds(hierarchy: list[ViewNode]) -> Optional[Bounds]:
+    roots = [bounds for bounds in (parse_bounds(node.get("bounds")) for node in hierarchy) if bounds]
+    if not roots:
+        return None
+    return min(b[0] for b in roots), min(b[1] for b in roots), max(b[2] for b in roots), max(b[3] for b in roots)
+
+
+def prune_hidden(hierarchy: list[ViewNode], screen: Optional[Bounds] = None, occlusion: bool = False) \
+        -> list[ViewNode]:
+    """Drops zero-area and offscreen nodes. With `occlusion` also drops nodes fully covered by a later drawn
+    layer, i.e. a non-leaf sibling of the node or of one of its ancestors. Dumps have no background or alpha,
+    so a transparent full-size container hides real content in this mode"""
+    screen = screen or screen_bounds(hierarchy)
+    return _prune(hierarchy, screen, [], occlusion) if screen else hierarchy
+
+
+def _prune(nodes: list[ViewNode], screen: Bounds, occluders: list[Bounds], occlusion: bool) -> list[ViewNode]:
+    siblings = [parse_bounds(node.get("bounds")) for node in nodes]
+    layers = [bounds if occlusion and node.get("children") else None for node, bounds in zip(nodes, siblings)]
+    result: list[ViewNode] = []
+
+    for position, node in enumerate(nodes):
+        bounds = siblings[position]
+        node_occluders = occluders + [layer for layer in layers[position + 1:] if layer and area(layer)]
+        if bounds:
+            if area(bounds) == 0 or not intersects(bounds, screen):
+                continue
+            if any(contains(occluder, bounds) for occluder in node_occluders):
+                continue
+
+        node_copy = ViewNode(node)
+        children = node.get("children")
+        if children:
+            node_copy["children"] = _prune(children, screen, node_occluders, occlusion)
+            if not node_copy["children"]:
+                node_copy.pop("children")
+        result.append(node_copy)
+
+    return result
+
+
+class SpatialIndex:
+    """Uniform grid index over node bounds for region queries. Root nodes of a dump are windows,
+    with `package` only the app ones count as windows, e.g. the status bar is not a dialog"""
+
+    def __init__(self, hierarchy: list[ViewNode], package: Optional[str] = None, cell_size: int = 200):
+        self._cell_size = cell_size
+        self._entries: list[tuple[Bounds, ViewNode]] = []
+        self._grid: dict[tuple[int, int], list[int]] = defaultdict(list)
+        self.windows = [
+            bounds for bounds in (
+                parse_bounds(node.get("bounds")) for node in hierarchy
+                if package is None or node.get("package") == package
+            ) if bounds
+        ]
+        self.screen = screen_bounds(hierarchy)
+
+        for node in self._walk(hierarchy):
+            bounds = parse_bounds(node.get("bounds"))
+            if bounds and area(bounds):
+                for cell in self._cells(bounds):
+                    self._grid[cell].append(len(self._entries))
+                self._entries.append((bounds, node))
+
+    @staticmethod
+    def _walk(nodes: list[ViewNode]) -> Iterator[ViewNode]:
+        for node in nodes:
+            yield node
+            yield from SpatialIndex._walk(node.get("children", []))
+
+    def _cells(self, bounds: Bounds) -> Iterator[tuple[int, int]]:
+        for x in range(bounds[0] // self._cell_size, (bounds[2] - 1) // self._cell_size + 1):
+            for y in range(bounds[1] // self._cell_size, (bounds[3] - 1) // self._cell_size + 1):
+                yield x, y
+
+    def query(self, region: Bounds, inside: bool = False) -> list[ViewNode]:
+        found = sorted({entry for cell in self._cells(region) for entry in self._grid.get(cell, [])})
+        return [
+            node for bounds, node in (self._entries[entry] for entry in found)
+            if (contains(region, bounds) if inside else intersects(region, bounds))
+        ]
+
+    def at(self, x: int, y: int) -> list[ViewNode]:
+        return self.query((x, y, x + 1, y + 1))
+
+    def region(self, name: str, fraction: float = 0.15) -> Bounds:
+        left, top, right, bottom = self.screen
+        height = bottom - top
+        regions = {
+            "top_bar": (left, top, right, top + int(height * fraction)),
+            "bottom_bar": (left, bottom - int(height * fraction), right, bottom),
+            "top_half": (left, top, right, top + height // 2),
+            "bottom_half": (left, top + height // 2, right, bottom),
+            "dialog": self.windows[-1] if len(self.windows) > 1 and self.windows[-1] != self.screen
+            else (left + (right - left) // 10, top + height // 5, right - (right - left) // 10, bottom - height // 5)
+        }
+        return regions[name]
+
+    def query_region(self, name: str) -> list[ViewNode]:
+        return self.query(self.region(name), inside=True)
@@ -0,0 +1,286 @@
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, TypeVar, Generic, Iterable, Callable
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, AIMessage, HumanMessage
+from langchain_core.output_parsers import PydanticOutputParser
+from pydantic import BaseModel, ValidationError
+
+T = TypeVar("T", bound=BaseModel)
+
+_string_end = re.compile(r'\s*(?:[,}\]:]|$)')
+_unicode_escape = re.compile(r"u[0-9a-fA-F]{4}")
+_trailing_comma = re.compile(r"\s*[}\]]")
+_control_escapes = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+
+
+def extract_json(text: str) -> str:
+    start = text.find("{")
+    end = text.rfind("}")
+    return text[start:end + 1] if start != -1 and end > start else text
+
+
+def repair_json(text: str) -> str:
+    """Fixes typical LLM mistakes in JSON strings: invalid escapes, raw control characters,
+    unescaped quotes inside of strings and trailing commas"""
+    result = []
+    in_string = False
+    i = 0
+
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            if char == "\\":
+                following = text[i + 1:i + 2]
+                if following and following in '"\\/bfnrt':
+                    result.append(char + following)
+                    i += 2
+                    continue
+                if _unicode_escape.match(text, i + 1):
+                    result.append(text[i:i + 6])
+                    i += 6
+                    continue
+                result.append("\\\\")
+            elif char == '"':
+                if _string_end.match(text, i + 1):
+                    in_string = False
+                    result.append(char)
+                else:
+                    result.append('\\"')
+            else:
+                result.append(_control_escapes.get(char, char))
+        elif char == '"':
+            in_string = True
+            result.append(char)
+        elif char == "," and _trailing_comma.match(text, i + 1):
+            pass
+        else:
+            result.append(char)
+        i += 1
+
+    return "".join(result)
+
+
+def loads(text: str) -> Any:
+    text = extract_json(text)
+    try:
+        return json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        return json.loads(repair_json(text), strict=False)
+
+
+class JsonObjectStream:
+    """Incrementally scans JSON text and returns objects closed at the given nesting depth
+    together with the key they are assigned to (None for array items)"""
+
+    _key_pattern = re.compile(r'"([^"\\]+)"\s*:\s*$')
+
+    def __init__(self, depth: int):
+        self._depth = depth
+        self._chunks: list[str] = []
+        self._tail = ""
+        self._level = 0
+        self._in_string = False
+        self._escaped = False
+        self._current: Optional[list[str]] = None
+        self._key: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    @property
+    def truncated(self) -> bool:
+        return self._level > 0
+
+    @property
+    def unfinished(self) -> Optional[tuple[Optional[str], str]]:
+        """Object at the given depth that is still open at the end of the input"""
+        return (self._key, "".join(self._current)) if self._current is not None else None
+
+    def feed(self, chunk: str) -> list[tuple[Optional[str], str]]:
+        completed = []
+        self._chunks.append(chunk)
+
+        for position, char in enumerate(chunk):
+            if self._current is not None:
+                self._current.append(char)
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._level += 1
+                if char == "{" and self._level == self._depth:
+                    self._current = [char]
+                    key = self._key_pattern.search((self._tail + chunk[:position])[-200:])
+                    self._key = key.group(1) if key else None
+            elif char in "}]":
+                if char == "}" and self._level == self._depth and self._current is not None:
+                    completed.append((self._key, "".join(self._current)))
+                    self._current = None
+                self._level -= 1
+
+        self._tail = (self._tail + chunk)[-200:]
+        return completed
+
+
+class RepairingOutputParser(Generic[T]):
+    """Pydantic output parser that repairs malformed JSON locally and, if it is still broken,
+    asks the model to resend only the broken `item_model` objects instead of the whole answer"""
+
+    _logger = logging.getLogger(__name__)
+    _max_continuations = 3
+
+    def __init__(self, pydantic_object: type[T], model: BaseChatModel, item_model: Optional[type[BaseModel]] = None):
+        self._pydantic_object = pydantic_object
+        self._model = model
+        self._item_model = item_model
+        self._parser = PydanticOutputParser(pydantic_object=pydantic_object)
+
+    def get_format_instructions(self) -> str:
+        return self._parser.get_format_instructions()
+
+    @property
+    def item_depth(self) -> int:
+        fields = self._pydantic_object.model_fields
+        return 3 if len(fields) == 1 else 2
+
+    def parse(self, text: str, messages: Optional[list[BaseMessage]] = None) -> T:
+        try:
+            return self._pydantic_object.model_validate(loads(text))
+        except (json.JSONDecodeError, ValidationError) as e:
+            if self._item_model is None:
+                raise OutputParserException(f"Failed to parse {self._pydantic_object.__name__}: {e}", llm_output=text)
+            self._logger.warning(f"Broken {self._pydantic_object.__name__}, repair by items: {e}")
+
+        fragments = self._fragments(messages or [], text)
+        items = [self.parse_item(fragment) for _, fragment, _ in fragments]
+        broken = [index for index, item in enumerate(items) if item is None]
+
+        if broken:
+            with ThreadPoolExecutor(max_workers=len(broken)) as executor:
+                repaired = executor.map(
+                    lambda index: self._request_item(fragments[index][2], fragments[index][1]), broken
+                )
+                for index, item in zip(broken, repaired):
+                    items[index] = item
+
+        fields = self._pydantic_object.model_fields
+        if len(fields) == 1:
+            data = {next(iter(fields)): items}
+        else:
+            data = {key: item for (key, _, _), item in zip(fragments, items)}
+        return self._pydantic_object.model_validate(data)
+
+    def parse_stream(self,
+                     chunks: Iterable[str],
+                     messages: Optional[list[BaseMessage]] = None,
+                     on_item: Optional[Callable[[BaseModel], None]] = None) -> T:
+        stream = JsonObjectStream(self.item_depth)
+        emitted = []
+
+        for chunk in chunks:
+            for _, fragment in stream.feed(chunk):
+                item = self.parse_item(fragment)
+                if item is not None:
+                    emitted.append(item)
+                    if on_item:
+                        on_item(item)
+
+        result = self.parse(stream.text, messages)
+        if on_item:
+            for item in self._items(result):
+                if item not in emitted:
+                    on_item(item)
+        return result
+
+    @staticmethod
+    def _items(result: BaseModel) -> list[BaseModel]:
+        values = [getattr(result, field) for field in type(result).model_fields]
+        return values[0] if len(values) == 1 else values
+
+    def parse_item(self, fragment: str) -> Optional[BaseModel]:
+        try:
+            return self._item_model.model_validate(loads(fragment))
+        except (json.JSONDecodeError, ValidationError):
+            return None
+
+    def _fragments(self,
+                   messages: list[BaseMessage],
+                   text: str) -> list[tuple[Optional[str], str, list[BaseMessage]]]:
+        """Item fragments of the answer with the conversation that produced them,
+        asks the model to continue the answer while it is cut off"""
+        fragments = []
+        conversation = messages + [AIMessage(text)]
+
+        for continuation in range(self._max_continuations + 1):
+            stream = JsonObjectStream(self.item_depth)
+            fragments += [(key, fragment, conversation) for key, fragment in stream.feed(text)]
+            if not stream.truncated:
+                break
+            if continuation == self._max_continuations:
+                raise OutputParserException(
+                    f"{self._pydantic_object.__name__} answer is still truncated "
+                    f"after {self._max_continuations} continuations", llm_output=text
+                )
+
+            if stream.unfinished and self._name(*stream.unfinished):
+                name = self._name(*stream.unfinished)
+                request = (f"Your answer was cut off inside {name}. Continue it: return a JSON object "
+                           f"in the same format with {name} again and all objects after it.")
+            elif fragments and self._name(*fragments[-1][:2]):
+                name = self._name(*fragments[-1][:2])
+                request = (f"Your answer was cut off after {name}. Continue it: return a JSON object "
+                           f"in the same format with only the objects after {name}.")
+            else:
+                raise OutputParserException(f"Truncated {self._pydantic_object.__name__} answer", llm_output=text)
+
+            self._logger.info(f"Request continuation of {self._pydantic_object.__name__} after {name}")
+            text = self._model.invoke(conversation + [HumanMessage(request)]).text()
+            conversation = conversation + [HumanMessage(request), AIMessage(text)]
+
+        if not fragments:
+            raise OutputParserException(f"No {self._item_model.__name__} objects in the answer", llm_output=text)
+        return fragments
+
+    @staticmethod
+    def _path(fragment: str) -> Optional[str]:
+        path = re.search(r'"relative_filepath"\s*:\s*"([^"]+)"', fragment)
+        return path.group(1) if path else None
+
+    def _name(self, key: Optional[str], fragment: str) -> Optional[str]:
+        path = self._path(fragment)
+        if path:
+            return f"`{path}`"
+        return f"`{key}`" if key else None
+
+    def _request_item(self, conversation: list[BaseMessage], fragment: str) -> BaseModel:
+        path = self._path(fragment)
+        name = f"`{path}`" if path else "object"
+        item_parser = PydanticOutputParser(pydantic_object=self._item_model)
+
+        self._logger.info(f"Request repair of {name}")
+        response = self._model.invoke(conversation + [
+            HumanMessage(f"The {name} in your answer is incomplete or not valid JSON. "
+                         f"Return only this one object again, correctly escaped.\n\n"
+                         f"{item_parser.get_format_instructions()}")
+        ])
+        item = self.parse_item(response.text())
+        if item is None:
+            raise OutputParserException(f"Failed to repair {name}", llm_output=response.text())
+        if path and getattr(item, "relative_filepath", path) != path:
+            raise OutputParserException(
+                f"Requested repair of {name}, got `{item.relative_filepath}`", llm_output=response.text()
+            )
+        return item
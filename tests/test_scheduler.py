@@ -0,0 +1,169 @@
+import threading
+import time
+from typing import Any, ClassVar, Optional
+
+import pytest
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
+
+from scheduler import LLMScheduler, Priority
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, condition: threading.Condition, timeout: Optional[float]):
+        """Simulated wait: time passes instantly for a single caller"""
+        self.now += timeout or 0
+
+
+class RateLimitError(Exception):
+
+    def __init__(self, retry_after: Optional[str] = None):
+        super().__init__("rate limited")
+        self.response = type("Response", (), {"headers": {"retry-after": retry_after} if retry_after else {}})()
+
+
+class FakeModel(BaseChatModel):
+    calls: ClassVar[list[str]] = []
+    failures: int = 0
+    release: Optional[threading.Event] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _respond(self, messages) -> str:
+        if self.release:
+            self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise RateLimitError("7")
+        text = messages[-1].content
+        self.calls.append(text)
+        return f"re: {text}"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        message = AIMessage(self._respond(messages), usage_metadata={
+            "input_tokens": 10, "output_tokens": 90, "total_tokens": 100
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        for word in self._respond(messages).split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    FakeModel.calls.clear()
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+def ask(scheduler: LLMScheduler, text: str, priority: Priority = Priority.BACKGROUND) -> str:
+    return scheduler.invoke([HumanMessage(text)], priority).text()
+
+
+def wait_until(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.001)
+
+
+def test_requests_per_minute(clock):
+    scheduler = LLMScheduler(FakeModel(), requests_per_minute=2, clock=clock, wait=clock.advance)
+
+    ask(scheduler, "a")
+    ask(scheduler, "b")
+    assert clock.now == 0
+
+    ask(scheduler, "c")
+    assert clock.now == pytest.approx(60)
+    assert scheduler.metrics()["requests"] == 3
+
+
+def test_tokens_per_minute(clock):
+    scheduler = LLMScheduler(FakeModel(), tokens_per_minute=100, clock=clock, wait=clock.advance)
+
+    ask(scheduler, "a")
+    assert scheduler.metrics()["window_tokens"] == 100
+    ask(scheduler, "b" * 40)
+
+    assert clock.now == pytest.approx(60)
+
+
+def test_priority_order(clock):
+    gate = threading.Condition.wait
+    scheduler = LLMScheduler(
+        FakeModel(), requests_per_minute=1, clock=clock,
+        wait=lambda condition, timeout: gate(condition, 0.001)
+    )
+    ask(scheduler, "first")
+
+    threads = [threading.Thread(target=ask, args=(scheduler, "background", Priority.BACKGROUND))]
+    threads[0].start()
+    wait_until(lambda: scheduler.metrics()["queue_depth"]["background"] == 1)
+    threads.append(threading.Thread(target=ask, args=(scheduler, "interactive", Priority.INTERACTIVE)))
+    threads[1].start()
+    wait_until(lambda: scheduler.metrics()["queue_depth"]["interactive"] == 1)
+
+    clock.now += 60
+    wait_until(lambda: len(FakeModel.calls) == 2)
+    clock.now += 60
+    for thread in threads:
+        thread.join(5)
+
+    assert FakeModel.calls == ["first", "interactive", "background"]
+
+
+def test_identical_requests_are_coalesced():
+    release = threading.Event()
+    scheduler = LLMScheduler(FakeModel(release=release))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(ask(scheduler, "same"))) for _ in range(3)]
+
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: scheduler.metrics()["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["re: same"] * 3
+    assert FakeModel.calls == ["same"]
+
+
+def test_rate_limit_pauses_and_retries(clock):
+    scheduler = LLMScheduler(FakeModel(failures=1), clock=clock, wait=clock.advance)
+
+    assert ask(scheduler, "a") == "re: a"
+    assert clock.now == pytest.approx(7)
+    assert scheduler.metrics()["rate_limited"] == 1
+
+
+def test_rate_limit_gives_up_after_max_retries(clock):
+    scheduler = LLMScheduler(FakeModel(failures=3), max_retries=2, clock=clock, wait=clock.advance)
+
+    with pytest.raises(RateLimitError):
+        ask(scheduler, "a")
+    assert scheduler.metrics()["rate_limited"] == 2
+
+
+def test_stream_retries_before_first_chunk(clock):
+    scheduler = LLMScheduler(FakeModel(failures=1), clock=clock, wait=clock.advance)
+
+    chunks = [chunk.content for chunk in scheduler.stream([HumanMessage("a b")], Priority.BACKGROUND)]
+
+    assert chunks == ["re:", "a", "b"]
+    assert clock.now == pytest.approx(7)
@@ -0,0 +1,98 @@
+import pytest
+
+from spatial_index import parse_bounds, prune_hidden, SpatialIndex
+from viewnode import parse_xml_to_tree, ViewNode
+
+APP = "com.example.app"
+
+
+def node(bounds: str, package: str = APP, children: list = (), **attributes) -> str:
+    attributes = "".join(f' {key.replace("_", "-")}="{value}"' for key, value in attributes.items())
+    return (f'<node index="0" class="android.widget.FrameLayout" package="{package}" bounds="{bounds}"{attributes}>'
+            f'{"".join(children)}</node>')
+
+
+@pytest.fixture
+def dump() -> list[ViewNode]:
+    return parse_xml_to_tree("<hierarchy>" + "".join([
+        node("[0,0][1080,1920]", children=[
+            node("[0,80][1080,1800]", resource_id="app:id/list", children=[
+                node("[0,80][1080,280]", text="Visible row"),
+                node("[0,2000][1080,2200]", text="Offscreen row"),
+                node("[0,300][0,300]", text="Zero area"),
+            ]),
+            node("[0,1800][1080,1920]", resource_id="app:id/bottom_bar", children=[
+                node("[0,1800][540,1920]", text="Home"),
+                node("[540,1800][1080,1920]", text="Settings"),
+            ]),
+        ]),
+        node("[140,600][940,1200]", children=[node("[200,1000][880,1150]", text="OK")]),
+        node("[0,0][1080,80]", package="com.android.systemui", text="12:00"),
+    ]) + "</hierarchy>")
+
+
+def texts(nodes: list[ViewNode]) -> list[str]:
+    found = []
+    for view in nodes:
+        if view.get("text"):
+            found.append(view.get("text"))
+        found += texts(view.get("children", []))
+    return found
+
+
+def labels(nodes: list[ViewNode]) -> list[str]:
+    return [view.get("text") for view in nodes if view.get("text")]
+
+
+def test_parse_bounds():
+    assert parse_bounds("[0,-10][1080,1920]") == (0, -10, 1080, 1920)
+    assert parse_bounds("") is None
+    assert parse_bounds("[0,0][1,]") is None
+
+
+def test_prune_hidden_drops_offscreen_and_zero_area_nodes(dump):
+    visible = texts(prune_hidden(dump))
+
+    assert "Visible row" in visible and "Home" in visible
+    assert "Offscreen row" not in visible and "Zero area" not in visible
+
+
+def test_prune_hidden_keeps_covered_nodes_without_occlusion(dump):
+    assert "Visible row" in texts(prune_hidden(dump))
+
+
+def test_prune_hidden_drops_covered_nodes_with_occlusion():
+    hierarchy = parse_xml_to_tree("<hierarchy>" + node("[0,0][1080,1920]", children=[
+        node("[0,0][1080,1920]", children=[node("[0,0][1080,200]", text="Covered")]),
+        node("[0,0][1080,1920]", children=[node("[0,0][1080,200]", text="Overlay")]),
+    ]) + "</hierarchy>")
+
+    assert texts(prune_hidden(hierarchy, occlusion=True)) == ["Overlay"]
+    assert texts(prune_hidden(hierarchy)) == ["Covered", "Overlay"]
+
+
+def test_query_and_at(dump):
+    index = SpatialIndex(dump, APP)
+
+    assert labels(index.query((0, 1800, 1080, 1920), inside=True)) == ["Home", "Settings"]
+    assert "Settings" in labels(index.at(800, 1850))
+    assert "Home" not in labels(index.at(800, 1850))
+
+
+def test_bottom_bar_region(dump):
+    index = SpatialIndex(dump, APP)
+
+    assert labels(index.query_region("bottom_bar")) == ["Home", "Settings"]
+
+
+def test_dialog_region_ignores_system_windows(dump):
+    index = SpatialIndex(dump, APP)
+
+    assert index.region("dialog") == (140, 600, 940, 1200)
+    assert labels(index.query_region("dialog")) == ["OK"]
+
+
+def test_dialog_region_falls_back_to_screen_center(dump):
+    index = SpatialIndex(dump[:1] + dump[2:], APP)
+
+    assert index.region("dialog") == (108, 384, 972, 1536)
@@ -0,0 +1,208 @@
+import json
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import HumanMessage
+
+from coder.automator import ProjectFiles
+from coder.kotlinfile import UITestsKotlinFile
+from coder.viewextractor import ViewExtraction
+from structured_output import repair_json, loads, JsonObjectStream, RepairingOutputParser
+
+
+class RecordingModel(FakeListChatModel):
+    requests: list = []
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        self.requests.append(messages)
+        return super()._call(messages, stop, run_manager, **kwargs)
+
+
+def kotlin_file(path: str, source: str = "class A") -> dict:
+    return {"relative_filepath": path, "source": source}
+
+
+def project_files(*paths: str) -> str:
+    return json.dumps({"kotlin_files": [kotlin_file(path) for path in paths]})
+
+
+@pytest.fixture
+def four_files() -> str:
+    return project_files("dsl/F0.kt", "dsl/F1.kt", "dsl/F2.kt", "dsl/F3.kt")
+
+
+@pytest.fixture
+def messages() -> list:
+    return [HumanMessage("Generate the files")]
+
+
+def parser(responses: list[str], pydantic_object=ProjectFiles) -> RepairingOutputParser:
+    return RepairingOutputParser(pydantic_object, RecordingModel(responses=responses), UITestsKotlinFile)
+
+
+def paths(result: ProjectFiles) -> list[str]:
+    return [file.relative_filepath for file in result.kotlin_files]
+
+
+@pytest.mark.parametrize("broken, expected", [
+    (r'{"a": "\d+"}', {"a": "\\d+"}),
+    ('{"a": "line\nbreak\ttab"}', {"a": "line\nbreak\ttab"}),
+    ('{"a": "say "hi" now"}', {"a": 'say "hi" now'}),
+    ('{"a": [1, 2,], "b": 3,}', {"a": [1, 2], "b": 3}),
+    (r'{"a": "\u00e9 \n \""}', {"a": 'é \n "'}),
+    ('{"a": "x", "b": "quote" inside"}', {"a": "x", "b": 'quote" inside'}),
+])
+def test_repair_json(broken, expected):
+    assert json.loads(repair_json(broken)) == expected
+
+
+def test_loads_extracts_json_from_markdown():
+    assert loads('Here it is:\n```json\n{"a": "\\d"}\n```') == {"a": "\\d"}
+
+
+def test_stream_ignores_braces_in_strings(four_files):
+    text = json.dumps({"kotlin_files": [kotlin_file("dsl/A.kt", 'fun a() { println("}{ [") }')]})
+    stream = JsonObjectStream(3)
+    items = stream.feed(text)
+
+    assert [json.loads(item) for _, item in items] == [kotlin_file("dsl/A.kt", 'fun a() { println("}{ [") }')]
+    assert not stream.truncated
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64])
+def test_stream_chunk_boundaries(four_files, chunk_size):
+    stream = JsonObjectStream(3)
+    items = []
+    for start in range(0, len(four_files), chunk_size):
+        items += stream.feed(four_files[start:start + chunk_size])
+
+    assert [json.loads(item)["relative_filepath"] for _, item in items] == [f"dsl/F{i}.kt" for i in range(4)]
+    assert stream.text == four_files
+    assert not stream.truncated and stream.unfinished is None
+
+
+def test_stream_keys_across_chunk_boundaries():
+    text = json.dumps({"actions": kotlin_file("a.kt"), "view": kotlin_file("v.kt")})
+    stream = JsonObjectStream(2)
+    items = [item for char in text for item in stream.feed(char)]
+
+    assert [key for key, _ in items] == ["actions", "view"]
+
+
+def test_stream_unfinished_item(four_files):
+    cut = four_files.index("dsl/F2.kt") + 5
+    stream = JsonObjectStream(3)
+    items = stream.feed(four_files[:cut])
+
+    assert len(items) == 2
+    assert stream.truncated
+    assert stream.unfinished == (None, four_files[four_files.rindex("{", 0, cut):cut])
+
+
+def test_parse_valid_answer_without_model_calls(four_files):
+    output_parser = parser([])
+
+    assert paths(output_parser.parse(four_files)) == [f"dsl/F{i}.kt" for i in range(4)]
+    assert output_parser._model.requests == []
+
+
+def test_parse_repairs_broken_item(messages):
+    text = project_files("dsl/F0.kt", "dsl/F1.kt").replace('"dsl/F1.kt", "source": "class A"', '"dsl/F1.kt"')
+    output_parser = parser([json.dumps(kotlin_file("dsl/F1.kt", "class B"))])
+
+    result = output_parser.parse(text, messages)
+
+    assert [file.source for file in result.kotlin_files] == ["class A", "class B"]
+    assert "`dsl/F1.kt`" in output_parser._model.requests[0][-1].content
+
+
+def test_parse_continues_answer_cut_inside_item(four_files, messages):
+    output_parser = parser([project_files("dsl/F2.kt", "dsl/F3.kt")])
+
+    result = output_parser.parse(four_files[:four_files.index("dsl/F2.kt") + 20], messages)
+
+    assert paths(result) == [f"dsl/F{i}.kt" for i in range(4)]
+    assert "cut off inside `dsl/F2.kt`" in output_parser._model.requests[0][-1].content
+
+
+def test_parse_continues_after_last_item_when_cut_inside_path(four_files, messages):
+    output_parser = parser([project_files("dsl/F2.kt", "dsl/F3.kt")])
+
+    result = output_parser.parse(four_files[:four_files.index("dsl/F2.kt") + 5], messages)
+
+    assert paths(result) == [f"dsl/F{i}.kt" for i in range(4)]
+    assert "cut off after `dsl/F1.kt`" in output_parser._model.requests[0][-1].content
+
+
+def test_parse_continues_answer_cut_between_items(four_files, messages):
+    output_parser = parser([project_files("dsl/F2.kt", "dsl/F3.kt")])
+
+    result = output_parser.parse(four_files[:four_files.index(', {"relative_filepath": "dsl/F2.kt"')], messages)
+
+    assert paths(result) == [f"dsl/F{i}.kt" for i in range(4)]
+    assert "cut off after `dsl/F1.kt`" in output_parser._model.requests[0][-1].content
+
+
+def test_parse_continues_several_times(four_files, messages):
+    second = project_files("dsl/F2.kt", "dsl/F3.kt")
+    output_parser = parser([second[:second.index("dsl/F3.kt")], project_files("dsl/F3.kt")])
+
+    result = output_parser.parse(four_files[:four_files.index("dsl/F2.kt")], messages)
+
+    assert paths(result) == [f"dsl/F{i}.kt" for i in range(4)]
+
+
+def test_parse_raises_when_still_truncated(four_files, messages):
+    cut = four_files[:four_files.index("dsl/F1.kt")]
+    output_parser = parser([cut] * (RepairingOutputParser._max_continuations + 1))
+
+    with pytest.raises(OutputParserException, match="still truncated"):
+        output_parser.parse(cut, messages)
+    assert len(output_parser._model.requests) == RepairingOutputParser._max_continuations
+
+
+def test_parse_raises_without_items():
+    with pytest.raises(OutputParserException, match="No UITestsKotlinFile objects"):
+        parser([]).parse('{"kotlin_files": "not a list"}')
+
+
+def test_parse_rejects_repair_of_another_file(messages):
+    text = project_files("dsl/F0.kt", "dsl/F1.kt").replace('"dsl/F1.kt", "source": "class A"', '"dsl/F1.kt"')
+    output_parser = parser([json.dumps(kotlin_file("dsl/Other.kt"))])
+
+    with pytest.raises(OutputParserException, match="got `dsl/Other.kt`"):
+        output_parser.parse(text, messages)
+
+
+def test_parse_multi_field_model(messages):
+    fields = ["actions", "assertions", "view", "screens_implementation"]
+    text = json.dumps({field: kotlin_file(f"{field}.kt") for field in fields})
+    text = text.replace('"view.kt", "source": "class A"', '"view.kt", "source": "class "V""')
+    output_parser = parser([], ViewExtraction)
+
+    result = output_parser.parse(text, messages)
+
+    assert result.view.source == 'class "V"'
+    assert [getattr(result, field).relative_filepath for field in fields] == [f"{field}.kt" for field in fields]
+
+
+def test_parse_multi_field_model_continuation(messages):
+    fields = ["actions", "assertions", "view", "screens_implementation"]
+    text = json.dumps({field: kotlin_file(f"{field}.kt") for field in fields})
+    rest = json.dumps({field: kotlin_file(f"{field}.kt") for field in fields[2:]})
+    output_parser = parser([rest], ViewExtraction)
+
+    result = output_parser.parse(text[:text.index('"view.kt"') + 3], messages)
+
+    assert result.screens_implementation.relative_filepath == "screens_implementation.kt"
+    assert "cut off inside `view`" in output_parser._model.requests[0][-1].content
+
+
+def test_parse_stream_emits_items(four_files):
+    emitted = []
+    result = parser([]).parse_stream(
+        [four_files[i:i + 10] for i in range(0, len(four_files), 10)], on_item=emitted.append
+    )
+
+    assert [file.relative_filepath for file in emitted] == paths(result) == [f"dsl/F{i}.kt" for i in range(4)]
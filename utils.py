@@ -1,4 +1,4 @@
-import anthropic
+from functools import lru_cache
 
 
 def get_file_content(path: str) -> str:
@@ -6,7 +6,18 @@ def get_file_content(path: str) -> str:
         return file.read()
 
 
+@lru_cache(maxsize=None)
+def get_prompt(path: str) -> str:
+    return get_file_content(path)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
 def count_tokens(text: str) -> int:
+    import anthropic
+
     client = anthropic.Anthropic(
         api_key=get_file_content('.anthropic_token')
     )
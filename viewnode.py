@@ -1,5 +1,6 @@
+import hashlib
 from xml.etree import ElementTree
-from typing import Dict
+from typing import Dict, Optional
 
 
 class ViewNode(Dict):
@@ -55,3 +56,46 @@ def without_fields(nodes: list[ViewNode], fields: list[str] = ()) -> list[ViewNo
         result.append(ViewNode(node_copy))
 
     return result
+
+
+def _structure(nodes: list[ViewNode], package: Optional[str] = None) -> str:
+    signatures: list[str] = []
+    for node in nodes:
+        if package and node.get("package") != package:
+            continue
+        signature = f"{node.get('class', '')}#{node.get('resource-id', '')}"
+        children = node.get("children")
+        if children:
+            signature += "(" + _structure(children, package) + ")"
+
+        if not signatures or signatures[-1] != signature:
+            signatures.append(signature)
+
+    return ",".join(signatures)
+
+
+def fingerprint(nodes: list[ViewNode], package: Optional[str] = None) -> str:
+    """Structural hash of the hierarchy, limited to the nodes of `package` (e.g. without the status bar)"""
+    return hashlib.sha1(_structure(nodes, package).encode("utf-8")).hexdigest()
+
+
+def count_nodes(nodes: list[ViewNode]) -> int:
+    return sum(1 + count_nodes(node.get("children", [])) for node in nodes)
+
+
+def skeleton(nodes: list[ViewNode], max_depth: int = 4) -> list[ViewNode]:
+    result: list[ViewNode] = []
+    previous = None
+    for node in nodes:
+        node_skeleton = ViewNode({k: v for k, v in node.items() if k in ("class", "resource-id")})
+        children = node.get("children")
+        if children and max_depth > 1:
+            node_skeleton["children"] = skeleton(children, max_depth - 1)
+
+        if node_skeleton == previous:
+            result[-1]["repeated"] = result[-1].get("repeated", 1) + 1
+        else:
+            previous = ViewNode(node_skeleton)
+            result.append(node_skeleton)
+
+    return result